@@ -0,0 +1,381 @@
+import os
+
+import numpy as np
+import networkx as nx
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components, shortest_path, dijkstra
+
+from timewindow.files import file_hash, written_aside
+
+
+# Parts of the graph smaller than this are not dissected further
+LEAF = 32
+
+# Arrays saved with a contraction, files missing any of them are built again
+ARRAYS = ('rank', 'parents', 'pointers', 'tails', 'heads', 'keys', 'lower_u', 'lower_w', 'target',
+          'segments', 'level_pointers', 'segment_pointers', 'by_arc', 'arc_pointers')
+
+
+def dissect(adjacency, nodes, order):
+
+    if len(nodes) <= LEAF:
+        order.extend(nodes)
+        return
+
+    part = adjacency[nodes][:, nodes]
+
+    count, labels = connected_components(part, directed=False)
+    if count > 1:
+        for component in range(count):
+            dissect(adjacency, nodes[labels == component], order)
+        return
+
+    # Breadth first levels from a pseudo-peripheral node, the middle level separates the rest
+    levels = shortest_path(part, unweighted=True, directed=False, indices=0)
+    levels = shortest_path(part, unweighted=True, directed=False, indices=int(np.argmax(levels))).astype(np.int64)
+
+    # The smallest level that leaves at most two thirds of the nodes on each side
+    counts = np.bincount(levels)
+    below = np.cumsum(counts) - counts
+    above = len(nodes) - below - counts
+
+    balanced = np.flatnonzero((below <= 2 * len(nodes) / 3.) & (above <= 2 * len(nodes) / 3.))
+    middle = int(balanced[np.argmin(counts[balanced])]) if len(balanced) else int(np.searchsorted(np.cumsum(counts), len(nodes) / 2.))
+
+    dissect(adjacency, nodes[levels < middle], order)
+    dissect(adjacency, nodes[levels > middle], order)
+
+    # Separators are contracted last
+    order.extend(nodes[levels == middle])
+
+
+class Contraction:
+
+    '''
+        Metric independent part of a customizable contraction hierarchy of the road
+        graph: a nested dissection order, the chordal graph of its upward arcs and
+        the lower triangles of every arc, grouped by elimination tree level so one
+        level is customized at once, and the parent of every rank in the elimination
+        tree. Only depends on the topology of the net.
+    '''
+
+    def __init__(self, names, arrays):
+
+        self.names = list(names)
+        self.index = dict((name, indx) for indx, name in enumerate(self.names))
+
+        for name in arrays:
+            setattr(self, name, arrays[name])
+
+        # Read one at a time when paths are unpacked and ancestors walked
+        self.tail_list = self.tails.tolist()
+        self.head_list = self.heads.tolist()
+        self.parent_list = self.parents.tolist()
+        self.by_rank = [self.names[node] for node in np.argsort(self.rank)]
+
+
+    @classmethod
+    def build(cls, graph):
+
+        names = list(graph.nodes())
+        index = dict((name, indx) for indx, name in enumerate(names))
+        n = len(names)
+
+        sources = np.array([index[source] for source, _ in graph.edges()], dtype=np.int64)
+        targets = np.array([index[target] for _, target in graph.edges()], dtype=np.int64)
+        adjacency = sparse.csr_matrix((np.ones(len(sources)), (sources, targets)), shape=(n, n))
+        adjacency = (adjacency + adjacency.T).tocsr()
+
+        order = []
+        dissect(adjacency, np.arange(n), order)
+        order = np.array(order, dtype=np.int64)
+
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n)
+
+        # Symbolic elimination, the upward neighbors of a node join those of its parent
+        upper = [set() for _ in range(n)]
+        for low, high in zip(np.minimum(rank[sources], rank[targets]).tolist(), np.maximum(rank[sources], rank[targets]).tolist()):
+            if low != high:
+                upper[low].add(high)
+
+        parents = np.full(n, -1, dtype=np.int64)
+        for node in range(n):
+            if upper[node]:
+                parent = min(upper[node])
+                parents[node] = parent
+                upper[parent].update(upper[node])
+                upper[parent].discard(parent)
+
+        heads = [sorted(upper[node]) for node in range(n)]
+        pointers = np.concatenate([[0], np.cumsum([len(up) for up in heads])]).astype(np.int64)
+        tails = np.repeat(np.arange(n), np.diff(pointers))
+        heads = np.array([head for up in heads for head in up], dtype=np.int64)
+        keys = tails * n + heads
+
+        # A node can only be customized after every node below it that reaches it
+        levels = np.zeros(n, dtype=np.int64)
+        for node in range(n):
+            up = heads[pointers[node]:pointers[node + 1]]
+            levels[up] = np.maximum(levels[up], levels[node] + 1)
+
+        # Lower triangles (x, u, w) as the arcs x-u, x-w and u-w
+        lower_u, lower_w, target, tri_levels = [], [], [], []
+        for node in range(n):
+            first, count = pointers[node], pointers[node + 1] - pointers[node]
+            if count < 2:
+                continue
+
+            i, j = np.triu_indices(count, 1)
+            up = heads[first:first + count]
+
+            lower_u.append(first + i)
+            lower_w.append(first + j)
+            target.append(np.searchsorted(keys, up[i] * n + up[j]))
+            tri_levels.append(np.full(len(i), levels[node], dtype=np.int64))
+
+        empty = np.empty(0, dtype=np.int64)
+        lower_u = np.concatenate(lower_u) if lower_u else empty
+        lower_w = np.concatenate(lower_w) if lower_w else empty
+        target = np.concatenate(target) if target else empty
+        tri_levels = np.concatenate(tri_levels) if tri_levels else empty
+
+        sort = np.lexsort((target, tri_levels))
+        lower_u, lower_w, target, tri_levels = lower_u[sort], lower_w[sort], target[sort], tri_levels[sort]
+
+        # Triangles of a level and arc are reduced together
+        change = np.ones(len(target), dtype=bool)
+        change[1:] = (tri_levels[1:] != tri_levels[:-1]) | (target[1:] != target[:-1])
+        segments = np.flatnonzero(change)
+
+        level_pointers = np.searchsorted(tri_levels, np.arange(levels.max() + 2 if n else 1))
+        segment_pointers = np.searchsorted(segments, level_pointers)
+
+        # Triangles of every arc, to unpack shortcuts
+        by_arc = np.argsort(target, kind='mergesort')
+        arc_pointers = np.searchsorted(target[by_arc], np.arange(len(heads) + 1))
+
+        arrays = {
+            'rank': rank, 'parents': parents, 'pointers': pointers, 'tails': tails, 'heads': heads, 'keys': keys,
+            'lower_u': lower_u, 'lower_w': lower_w, 'target': target, 'segments': segments,
+            'level_pointers': level_pointers, 'segment_pointers': segment_pointers,
+            'by_arc': by_arc, 'arc_pointers': arc_pointers
+        }
+
+        return cls(names, arrays)
+
+
+    def save(self, path):
+
+        arrays = dict((name, getattr(self, name)) for name in ARRAYS)
+
+        with written_aside(path) as (temporary,):
+            np.savez(temporary, names=np.array(self.names), **arrays)
+
+
+    @classmethod
+    def load(cls, path):
+
+        data = np.load(path)
+        if any(name not in data.files for name in ARRAYS):
+            return None
+
+        return cls(data['names'].tolist(), dict((name, data[name]) for name in data.files if name != 'names'))
+
+
+def load_contraction(graph, network, folder='./data/routing/'):
+
+    # One contraction per net file, the first process that needs it builds it
+    path = os.path.join(folder, '{0}.{1}.npz'.format(os.path.basename(network), file_hash(network)))
+
+    if os.path.exists(path):
+        contraction = Contraction.load(path)
+        if contraction is not None and set(contraction.names) == set(graph.nodes()):
+            return contraction
+
+    contraction = Contraction.build(graph)
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    contraction.save(path)
+
+    return contraction
+
+
+class CustomizableHierarchy:
+
+    '''
+        Shortest paths of a rerouting interval on a customized contraction hierarchy,
+        same interface as graph_mannager.ShortestPaths. Customizing costs one pass over
+        the triangles. An upward search only reaches the elimination tree ancestors of
+        its road, so a query walks the ancestors of both ends and relaxes their upward
+        arcs alone, its state is sized to the ancestors and nothing is kept after it.
+    '''
+
+    def __init__(self, graph, contraction):
+
+        self.graph = graph
+        self.contraction = contraction
+
+        n = len(contraction.names)
+
+        # A road that leads to itself never shortens a route
+        self.edges = [(source, target) for source, target in graph.edges() if source != target]
+
+        low, high = [], []
+        for source, target in self.edges:
+            low.append(contraction.rank[contraction.index[source]])
+            high.append(contraction.rank[contraction.index[target]])
+
+        low, high = np.array(low, dtype=np.int64), np.array(high, dtype=np.int64)
+
+        # Roads going up the order weigh the arc upwards, the others downwards
+        self.upwards = low < high
+        self.arcs = np.searchsorted(contraction.keys, np.minimum(low, high) * n + np.maximum(low, high))
+
+        # Position of each rank in the ancestors of the current search, reused by every search
+        self.positions = np.zeros(n, dtype=np.int64)
+
+        self.update()
+
+
+    def update(self):
+
+        contraction = self.contraction
+        weights = np.array([self.graph.adj[source][target]["weight"] for source, target in self.edges], dtype=float)
+
+        up = np.full(len(contraction.heads), np.inf)
+        down = np.full(len(contraction.heads), np.inf)
+        up[self.arcs[self.upwards]] = weights[self.upwards]
+        down[self.arcs[~self.upwards]] = weights[~self.upwards]
+
+        self.base_up, self.base_down = up.copy(), down.copy()
+
+        for level in range(len(contraction.level_pointers) - 1):
+            first, last = contraction.level_pointers[level], contraction.level_pointers[level + 1]
+            if first == last:
+                continue
+
+            starts = contraction.segments[contraction.segment_pointers[level]:contraction.segment_pointers[level + 1]]
+            arcs = contraction.target[starts]
+
+            lower_u, lower_w = contraction.lower_u[first:last], contraction.lower_w[first:last]
+
+            # u -> x -> w improves the arc upwards, w -> x -> u downwards
+            up[arcs] = np.minimum(up[arcs], np.minimum.reduceat(down[lower_u] + up[lower_w], starts - first))
+            down[arcs] = np.minimum(down[arcs], np.minimum.reduceat(down[lower_w] + up[lower_u], starts - first))
+
+        self.up, self.down = up, down
+
+
+    def ancestors(self, root):
+
+        # Ranks from root up to its elimination tree root, increasing
+        parents = self.contraction.parent_list
+        chain = [root]
+
+        while parents[chain[-1]] >= 0:
+            chain.append(parents[chain[-1]])
+
+        return np.array(chain, dtype=np.int64)
+
+
+    def search(self, root, weights):
+
+        '''
+            Ancestors of root, with the distance and previous position among them of
+            each one, found following their arcs upwards with weights
+        '''
+
+        contraction = self.contraction
+        chain = self.ancestors(root)
+
+        # Upward arcs of the ancestors, their heads are ancestors too
+        pointers = np.concatenate(([0], np.cumsum(contraction.pointers[chain + 1] - contraction.pointers[chain])))
+        arcs = np.repeat(contraction.pointers[chain] - pointers[:-1], np.diff(pointers)) + np.arange(pointers[-1])
+
+        self.positions[chain] = np.arange(len(chain))
+
+        # Rows are the ancestors in order, arcs of infinite weight never settle their head
+        graph = sparse.csr_matrix((weights[arcs], self.positions[contraction.heads[arcs]], pointers), shape=(len(chain), len(chain)))
+
+        distances, previous = dijkstra(graph, directed=True, indices=0, return_predecessors=True)
+
+        return chain, distances, previous
+
+
+    def arc(self, low, high):
+        return int(np.searchsorted(self.contraction.keys, int(low) * len(self.contraction.names) + int(high)))
+
+
+    def unpack(self, arc, upwards, path):
+
+        # Appends the roads after the first one of an arc, shortcuts are replaced by their two arcs
+        contraction = self.contraction
+        stack = [(arc, upwards)]
+
+        while stack:
+            arc, upwards = stack.pop()
+
+            weight = self.up[arc] if upwards else self.down[arc]
+            if weight == (self.base_up[arc] if upwards else self.base_down[arc]):
+                path.append(contraction.head_list[arc] if upwards else contraction.tail_list[arc])
+                continue
+
+            triangles = contraction.by_arc[contraction.arc_pointers[arc]:contraction.arc_pointers[arc + 1]]
+            lower_u, lower_w = contraction.lower_u[triangles], contraction.lower_w[triangles]
+
+            if upwards:
+                match = np.flatnonzero(self.down[lower_u] + self.up[lower_w] == weight)[0]
+                stack.append((lower_w[match], True))
+                stack.append((lower_u[match], False))
+            else:
+                match = np.flatnonzero(self.down[lower_w] + self.up[lower_u] == weight)[0]
+                stack.append((lower_u[match], True))
+                stack.append((lower_w[match], False))
+
+
+    def path(self, source, destination):
+
+        contraction = self.contraction
+
+        for node in (source, destination):
+            if node not in contraction.index:
+                raise nx.NodeNotFound("Node %s not in graph." % node)
+
+        start, end = int(contraction.rank[contraction.index[source]]), int(contraction.rank[contraction.index[destination]])
+
+        # From the source with the up weights, from the destination with the down ones
+        forward_chain, forward, forward_previous = self.search(start, self.up)
+        backward_chain, backward, backward_previous = self.search(end, self.down)
+
+        # Both searches meet on the common ancestors, none when the ends are in different parts of the net
+        common, forward_common, backward_common = np.intersect1d(forward_chain, backward_chain, assume_unique=True, return_indices=True)
+
+        total = forward[forward_common] + backward[backward_common]
+
+        if len(common) == 0 or total.min() == np.inf:
+            raise nx.NetworkXNoPath("No path between %s and %s." % (source, destination))
+
+        best = int(np.argmin(total))
+
+        # Upward arcs from the source to the middle, then downward ones to the destination
+        climb = [int(forward_common[best])]
+        while climb[-1] != 0:
+            climb.append(forward_previous[climb[-1]])
+
+        climb = forward_chain[climb[::-1]].tolist()
+
+        ranks = [start]
+        for low, high in zip(climb[:-1], climb[1:]):
+            self.unpack(self.arc(low, high), True, ranks)
+
+        node = int(backward_common[best])
+        while node != 0:
+            low = backward_previous[node]
+            self.unpack(self.arc(backward_chain[low], backward_chain[node]), False, ranks)
+            node = low
+
+        # Same (length, path) as bidirectional_dijkstra
+        return total[best], [contraction.by_rank[node] for node in ranks]
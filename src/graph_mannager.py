@@ -1,4 +1,7 @@
+import numpy as np
 import networkx as nx
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
 from bs4 import BeautifulSoup
 import matplotlib.pyplot as plt
 
@@ -42,3 +45,145 @@ def build_road_graph(network):
             graph.add_edge(source_edge.encode("ascii"), dest_edge.encode("ascii"), id=source_edge, length=edges_length[source_edge], weight=0)
 
     return graph
+
+
+class ShortestPaths:
+
+    '''
+        Shortest paths on the road graph kept as compressed sparse rows. One reverse
+        Dijkstra per destination gives the next road towards it from every road, so
+        all the vehicles going to the same road share a single search
+    '''
+
+    def __init__(self, graph):
+
+        self.graph = graph
+        self.nodes = list(graph.nodes())
+        self.index = dict((node, indx) for indx, node in enumerate(self.nodes))
+
+        edges = list(graph.edges())
+        self.rows = np.array([self.index[source] for source, _ in edges], dtype=np.int32)
+        self.columns = np.array([self.index[target] for _, target in edges], dtype=np.int32)
+
+        self.update()
+
+
+    def update(self):
+
+        # Called when weights change, searches of the old weights are dropped
+        weights = np.array([self.graph.adj[self.nodes[row]][self.nodes[column]]["weight"] for row, column in zip(self.rows, self.columns)], dtype=float)
+
+        # Transposed, a search from the destination follows the roads backwards
+        self.reverse = sparse.csr_matrix((weights, (self.columns, self.rows)), shape=(len(self.nodes), len(self.nodes)))
+        self.weights = dict(zip(zip(self.rows.tolist(), self.columns.tolist()), weights.tolist()))
+        self.trees = {}
+
+
+    def search(self, destination):
+
+        # Only the next roads are kept, lengths are summed along the path
+        if destination not in self.trees:
+            self.trees[destination] = dijkstra(self.reverse, directed=True, indices=destination, return_predecessors=True)[1]
+
+        return self.trees[destination]
+
+
+    def path(self, source, destination):
+
+        for node in (source, destination):
+            if node not in self.index:
+                raise nx.NodeNotFound("Node %s not in graph." % node)
+
+        target = self.index[destination]
+        next_roads = self.search(target)
+
+        node = self.index[source]
+        indices = [node]
+
+        while node != target:
+            node = next_roads[node]
+            if node < 0:
+                raise nx.NetworkXNoPath("No path between %s and %s." % (source, destination))
+
+            indices.append(node)
+
+        # Added from the destination as the search did, the same float it found
+        length = 0.0
+        for road, next_road in reversed(list(zip(indices[:-1], indices[1:]))):
+            length += self.weights[(road, next_road)]
+
+        # Same (length, path) as bidirectional_dijkstra
+        return length, [self.nodes[node] for node in indices]
+
+
+class RouteCache:
+
+    '''
+        Routes of the current weight epoch keyed by (source, destination, epoch). The
+        epoch advances at every rerouting, after update_context_on_roads, and when the
+        popularity updates move some weight more than tolerance, relative to its value
+        when the epoch began. Smaller moves keep the routes and the searches they came from
+    '''
+
+    def __init__(self, tolerance=0.0):
+        self.tolerance = tolerance
+
+        self.epoch = 0
+        self.routes = {}
+        self.weights = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.epochs = 0
+
+
+    def advance(self):
+
+        self.epoch += 1
+        self.epochs += 1
+
+        self.routes = {}
+        self.weights = {}
+
+
+    def path(self, shortest_paths, source, destination):
+
+        key = (source, destination, self.epoch)
+
+        if key in self.routes:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.routes[key] = shortest_paths.path(source, destination)
+
+        return self.routes[key]
+
+
+    def watch(self, graph, road):
+
+        # Weights of the roads leaving road as the epoch began, before they are updated
+        for successor_road in graph.successors(road):
+            self.weights.setdefault((road, successor_road), graph.adj[road][successor_road]["weight"])
+
+
+    def stale(self, graph, roads):
+
+        # True when a weight leaving roads moved more than tolerance, the epoch advances. Other watched weights did not move since the last call
+        for road in roads:
+            for successor_road in graph.successors(road):
+                weight = self.weights[(road, successor_road)]
+                if abs(graph.adj[road][successor_road]["weight"] - weight) > self.tolerance * abs(weight):
+                    self.advance()
+                    return True
+
+        return False
+
+
+    def stats(self):
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'epochs': self.epochs,
+            'tolerance': self.tolerance
+        }
@@ -14,6 +14,7 @@ import argparse
 import sumo_mannager
 import graph_mannager
 import traffic_mannager
+import cch_mannager
 import traci
 
 #import inspect
@@ -21,6 +22,10 @@ import traci
 #parent_dir = os.path.dirname(current_dir)
 #sys.path.insert(0, parent_dir)
 from timewindow.contextual import Contextual
+from timewindow.scenariobox import find_box, MARGIN
+from timewindow.edgescores import EdgeScores
+from timewindow.kernelcache import BUDGET
+from timewindow.netprojection import read_projection
 
 
 class Simulation:
@@ -61,6 +66,28 @@ class Simulation:
 			json.dump(metrics, write_file, indent=4)
 
 
+	def create_cache_file(self, stats, iterate, config, city, day, name='cache'):
+
+		with open('./output/data/{0}/{1}/{2}/{3}_{4}.json'.format(day, city, config, iterate, name), "w") as write_file:
+			json.dump(stats, write_file, indent=4)
+
+
+	def load_edge_scores(self, contextual, network, road_network_graph, lanes):
+
+		edge_scores = EdgeScores()
+		signature = edge_scores.signature(contextual, network)
+
+		# The first run of a net and day scores its lane shapes, later runs map the table
+		if not edge_scores.load(contextual.day, contextual.city, signature):
+			roads = list(road_network_graph.nodes())
+			starts, ends = [lanes[road]['start'] for road in roads], [lanes[road]['end'] for road in roads]
+
+			edge_scores.build(contextual, signature, roads, starts, ends)
+			edge_scores.load(contextual.day, contextual.city, signature)
+
+		return edge_scores
+
+
 	def run(self, network, begin, end, interval, route_log, replication, p, iterate, indx_config, config, city, day):
 
 		logging.debug("Building road graph")
@@ -68,7 +95,16 @@ class Simulation:
 
 		error_count, total_count = 0, 0
 		logging.debug("Reading contextual data")
-		contextual = Contextual(city=city, day=day)
+		box = find_box(city, net=network, margin=self.margin) if self.bbox else None
+		contextual = Contextual(city=city, day=day, summary=self.summary, box=box, raster=self.raster, kde=self.kde, cache_size=self.cache_size)
+
+		# Static lane attributes, the loop below only asks SUMO for what changes
+		lanes = traffic_mannager.cache_lanes(road_network_graph, network)
+		edge_scores = self.load_edge_scores(contextual, network, road_network_graph, lanes) if self.table else None
+
+		# Order of the road graph, only the weights change between reroutings
+		contraction = cch_mannager.load_contraction(road_network_graph, network) if self.routing == 'cch' else None
+		route_cache = graph_mannager.RouteCache(self.tolerance)
 
 		logging.debug("Running simulation now")
 		step = 1
@@ -77,24 +113,39 @@ class Simulation:
 		road_map = {}
 		all_metrics = []
 
+		# Kernels of the next rerouting are fitted while SUMO steps
+		if edge_scores is None:
+			contextual.prefetch(interval // 35)
+
+		# Roads and vehicles are read with one call per domain at each rerouting
+		traffic_mannager.subscribe_roads(road_network_graph)
+
 		while step == 1 or traci.simulation.getMinExpectedNumber() > 0:
 
 			logging.debug("Minimum expected number of vehicles: %d" % traci.simulation.getMinExpectedNumber())
 			traci.simulationStep()
+			traffic_mannager.subscribe_departed()
 
 			if step >= travel_time_cycle_begin and travel_time_cycle_begin <= end and step%interval == 0:
 
-				road_network_graph = traffic_mannager.update_context_on_roads(road_network_graph, contextual, step, indx_config, road_map)
+				state = traffic_mannager.read_state()
+
+				road_network_graph = traffic_mannager.update_context_on_roads(road_network_graph, contextual, step, indx_config, road_map, state, lanes, edge_scores)
 				logging.debug("Updating travel time on roads at simulation time %d" % step)
 
-				error_count, total_count, acumulated_context = traffic_mannager.reroute_vehicles(road_network_graph, p, error_count, total_count, indx_config, road_map)
+				error_count, total_count, acumulated_context = traffic_mannager.reroute_vehicles(road_network_graph, p, error_count, total_count, indx_config, road_map, contextual, step, state, lanes, contraction, route_cache)
 				all_metrics += acumulated_context
 
+				if edge_scores is None:
+					contextual.prefetch((step + interval) // 35)
+
 			step += 1
 
 		traffic, crimes, crashes = self.iterate_metrics(all_metrics)
 
 		self.create_output_file(total_count, total_count - error_count, error_count, traffic, crimes, crashes, iterate, config, city, day)
+		self.create_cache_file(contextual.kernels.stats(), iterate, config, city, day)
+		self.create_cache_file(route_cache.stats(), iterate, config, city, day, name='routes')
 
 		logging.debug("Simulation finished")
 		traci.close()
@@ -160,10 +211,21 @@ class Simulation:
 		# 	os.remove('./src/sumo-launchd.log')
 
 
-	def main(self, times=20, cities=['austin']):
+	def main(self, times=20, cities=['austin'], summary=False, bbox=False, margin=MARGIN, raster=False, kde='gaussian', table=False, cache_size=BUDGET, routing='dijkstra', tolerance=0.0):
 
 		print('!# Begin')
 
+		# Read by every simulation process forked below
+		self.summary = summary
+		self.bbox = bbox
+		self.margin = margin
+		self.raster = raster
+		self.kde = kde
+		self.table = table
+		self.cache_size = cache_size
+		self.routing = routing
+		self.tolerance = tolerance
+
 		for day in ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday']:
 
 			print('! ' + day.capitalize())
@@ -172,6 +234,26 @@ class Simulation:
 
 				print('! City: {0}'.format(city))
 
+				# Rasters are built once here and memory-mapped by the processes
+				if raster:
+					print('! Build risk rasters')
+					box = find_box(city, margin=margin) if bbox else None
+					Contextual(city=city, day=day, summary=summary, box=box, raster=True, kde=kde)
+
+				# Edge tables are built here when the net can be projected without SUMO
+				network = './scenario/{0}.net.xml'.format(city)
+				if table and os.path.exists(network) and read_projection(network) is not None:
+					print('! Build edge score tables')
+					box = find_box(city, net=network, margin=margin) if bbox else None
+					contextual = Contextual(city=city, day=day, summary=summary, box=box, raster=raster, kde=kde, cache_size=cache_size)
+					road_network_graph = graph_mannager.build_road_graph(network)
+					self.load_edge_scores(contextual, network, road_network_graph, traffic_mannager.cache_lanes(road_network_graph, network))
+
+				# Contraction orders are built once per net before the processes need them
+				if routing == 'cch' and os.path.exists(network):
+					print('! Build contraction order')
+					cch_mannager.load_contraction(graph_mannager.build_road_graph(network), network)
+
 				if not os.path.exists('./output/data'):
 					os.makedirs('./output/data')
 
@@ -1,9 +1,14 @@
 import traci
+import traci.constants as tc
 import logging
-import networkx as nx
+import numpy as np
 import random
 import json
 
+import graph_mannager
+import cch_mannager
+from timewindow.netprojection import read_lanes, edge_coords
+
 
 CONTEXT_CONFIG = {'0' : {'traffic': 1.0, 'crimes': 0.0, 'crashes': 0.0},
                   '1' : {'traffic': 0.0, 'crimes': 1.0, 'crashes': 0.0},
@@ -20,6 +25,10 @@ CONTEXT_CONFIG = {'0' : {'traffic': 1.0, 'crimes': 0.0, 'crashes': 0.0},
                   '12' : {'traffic': 0.0, 'crimes': 0.75, 'crashes': 0.25},
                   '13' : {'traffic': 0.0, 'crimes': 0.0, 'crashes': 0.0}}
 
+# Read from SUMO once per step through subscriptions
+EDGE_VARIABLES = [tc.LAST_STEP_MEAN_SPEED, tc.LAST_STEP_VEHICLE_NUMBER]
+VEHICLE_VARIABLES = [tc.VAR_ROAD_ID, tc.VAR_EDGES]
+
 
 def invert_coords(coord):
     return (coord[1], coord[0])
@@ -51,32 +60,105 @@ def output_ids_coords(graph):
         json.dump(just_to_save, write_file, indent=4)
 
 
-def update_context_on_roads(graph, contextual, step, indx_config, road_map):
+def subscribe_roads(graph):
 
-    #output_ids_coords(graph)
-    
     for road in graph.nodes():
+        traci.edge.subscribe(road, EDGE_VARIABLES)
 
-        if road not in road_map.keys():
-            road_map[str(road)] = {'traffic': 0, 'crimes': 0, 'crashes': 0, 'popularity': {'weight': {}, 'count': {}}}
+    traci.simulation.subscribe([tc.VAR_DEPARTED_VEHICLES_IDS])
+
+
+def subscribe_departed():
+
+    # Called after every step, vehicles are unsubscribed by SUMO when they arrive
+    for vehicle in traci.simulation.getSubscriptionResults()[tc.VAR_DEPARTED_VEHICLES_IDS]:
+        traci.vehicle.subscribe(vehicle, VEHICLE_VARIABLES)
+
+
+def read_state():
+
+    # Mean speeds and vehicle counts of every road, road and route of every vehicle
+    return {'edges': traci.edge.getAllSubscriptionResults(), 'vehicles': traci.vehicle.getAllSubscriptionResults()}
+
+
+def read_traffic(roads, state, lanes):
+
+    traffic = []
 
-        # Traffic
-        average_speed = traci.edge.getLastStepMeanSpeed(road)
-        max_speed = traci.lane.getMaxSpeed(str(road) + "_0")
-        traffic = float(max_speed - average_speed) / float(max_speed)
+    for road in roads:
+        average_speed = state['edges'][road][tc.LAST_STEP_MEAN_SPEED]
+        max_speed = lanes[road]['max_speed']
+        traffic.append(float(max_speed - average_speed) / float(max_speed))
 
-        # Geo coordinates
+    return traffic
+
+
+def read_coords(roads):
+
+    starts, ends = [], []
+
+    for road in roads:
         lane_coords = traci.lane.getShape(str(road) + "_0")
         start = traci.simulation.convertGeo(*lane_coords[0])
         end = traci.simulation.convertGeo(*lane_coords[1])
 
-        start = invert_coords(start)
-        end = invert_coords(end)
-        
-        # Trade-off
-        step_time = step // 35
-        weight, metrics = contextual.trade_off(traffic, start, end, step_time, context_weight=CONTEXT_CONFIG[str(indx_config)])
-        update_road_map(road_map, str(road), metrics)
+        starts.append(invert_coords(start))
+        ends.append(invert_coords(end))
+
+    return starts, ends
+
+
+def cache_lanes(graph, network):
+
+    '''
+        Static attributes of lane 0 of every road read once per run, speed, length and
+        lane count from the net file, start and end projected from it or asked to SUMO
+    '''
+
+    roads = list(graph.nodes())
+    attributes = read_lanes(network)
+
+    coords = edge_coords(network, roads)
+    starts, ends = coords if coords is not None else read_coords(roads)
+
+    lanes = {}
+    for indx, road in enumerate(roads):
+        lanes[road] = {'max_speed': attributes[road]['speed'], 'length': attributes[road]['length'], 'lanes': attributes[road]['lanes'], 'start': starts[indx], 'end': ends[indx]}
+
+    return lanes
+
+
+def update_context_on_roads(graph, contextual, step, indx_config, road_map, state, lanes, edge_scores=None):
+
+    #output_ids_coords(graph)
+
+    roads = list(graph.nodes())
+
+    for road in roads:
+        if road not in road_map.keys():
+            road_map[str(road)] = {'traffic': 0, 'crimes': 0, 'crashes': 0, 'popularity': {'weight': {}, 'count': {}}}
+
+    traffic = read_traffic(roads, state, lanes)
+
+    # Trade-off of every road at once
+    step_time = step // 35
+    context_weight = CONTEXT_CONFIG[str(indx_config)]
+
+    if edge_scores is not None:
+        weights, metrics = contextual.combine_scores(traffic, edge_scores.context_scores(roads, step_time), context_weight)
+
+    else:
+        # Contexts weighted zero are left as None
+        starts, ends = [lanes[road]['start'] for road in roads], [lanes[road]['end'] for road in roads]
+        weights, metrics = contextual.trade_off_batch(traffic, starts, ends, step_time, context_weight=context_weight)
+
+        for indx, road in enumerate(roads):
+            road_map[str(road)]['coords'] = (starts[indx], ends[indx])
+
+    for indx, road in enumerate(roads):
+
+        weight = float(weights[indx])
+        update_road_map(road_map, str(road), dict((context, None if metrics[context] is None else float(metrics[context][indx])) for context in metrics))
 
         for successor_road in graph.successors(road):
             graph.adj[road][successor_road]["weight"] = weight
@@ -92,7 +174,29 @@ def update_context_on_roads(graph, contextual, step, indx_config, road_map):
     return graph
 
 
-def update_weight_by_popularity(graph, road, road_map):
+def fill_skipped_metrics(road_map, routes, contextual, step):
+
+    # Contexts weighted zero were not scored, only the roads of the new routes need them
+    roads = sorted(set(road for route in routes for road in route if None in (road_map[road]['crimes'], road_map[road]['crashes'])))
+
+    if not roads:
+        return
+
+    starts = np.array([road_map[road]['coords'][0] for road in roads])
+    ends = np.array([road_map[road]['coords'][1] for road in roads])
+
+    skipped = set(context for road in roads for context in ('crimes', 'crashes') if road_map[road][context] is None)
+    scores = contextual.context_scores(starts, ends, step // 35, contexts=skipped)
+
+    for indx, road in enumerate(roads):
+        for context in scores:
+            if road_map[road][context] is None:
+                road_map[road][context] = float(scores[context][indx])
+
+
+def update_weight_by_popularity(graph, road, road_map, state, lanes):
+
+    changed = False
 
     for successor_road in graph.successors(road):
 
@@ -100,29 +204,46 @@ def update_weight_by_popularity(graph, road, road_map):
 
             road_map[str(road)]['popularity']['count'][successor_road] += 1
             
-            length = traci.lane.getLength(str(road) + "_0")
-            lines = traci.edge.getLaneNumber(road)
-            laststep_vehicles = traci.edge.getLastStepVehicleNumber(road)
+            length = lanes[road]['length']
+            lines = lanes[road]['lanes']
+            laststep_vehicles = state['edges'][road][tc.LAST_STEP_VEHICLE_NUMBER]
 
             road_capacity = (length * lines) / 5
             vehicle_load = laststep_vehicles + road_map[str(road)]['popularity']['count'][successor_road]
             load_percentage = vehicle_load / road_capacity
 
             graph.adj[road][successor_road]["weight"] = road_map[str(road)]['popularity']['weight'][successor_road] + road_map[str(road)]['popularity']['weight'][successor_road] * load_percentage
+            changed = True
 
+    return changed
 
-def reroute_vehicles(graph, p, error_count, total_count, indx_config, road_map):
 
-    vehicles = list(set(traci.vehicle.getIDList()))
+def reroute_vehicles(graph, p, error_count, total_count, indx_config, road_map, contextual, step, state, lanes, contraction=None, route_cache=None):
+
+    vehicles = list(state['vehicles'].keys())
     vehicles.sort()
 
     acumulated_context = []
+    routes = []
+
+    # Searches are shared by vehicles with the same destination until a weight changes
+    shortest_paths = None
+    if indx_config != 13:
+        if contraction is not None:
+            shortest_paths = cch_mannager.CustomizableHierarchy(graph, contraction)
+        else:
+            shortest_paths = graph_mannager.ShortestPaths(graph)
+
+    # update_context_on_roads has just changed the weights, routes of the last rerouting are dropped
+    if route_cache is None:
+        route_cache = graph_mannager.RouteCache()
+    route_cache.advance()
 
     for vehicle in vehicles:
 
-        source = traci.vehicle.getRoadID(vehicle)
+        source = state['vehicles'][vehicle][tc.VAR_ROAD_ID]
         if source.startswith(":"): continue
-        route = traci.vehicle.getRoute(vehicle)
+        route = state['vehicles'][vehicle][tc.VAR_EDGES]
         destination = route[-1]
 
         if source != destination:
@@ -135,23 +256,36 @@ def reroute_vehicles(graph, p, error_count, total_count, indx_config, road_map):
                 indx_source = route.index(source)
                 shortest_path = [1, route[indx_source:]]
             else:
-                shortest_path = nx.algorithms.shortest_paths.weighted.bidirectional_dijkstra(graph, source, destination, "weight")
+                shortest_path = route_cache.path(shortest_paths, source, destination)
 
             #try:
             total_count+=1
             traci.vehicle.setRoute(vehicle, shortest_path[1])
 
-            context_metrics = {'traffic': 0, 'crimes': 0, 'crashes': 0}
+            changed = False
             for vertex in list(shortest_path[1]):
-                context_metrics['traffic'] += road_map[vertex]['traffic']
-                context_metrics['crimes'] += road_map[vertex]['crimes']
-                context_metrics['crashes'] += road_map[vertex]['crashes']
+                route_cache.watch(graph, vertex)
+                changed = update_weight_by_popularity(graph, vertex, road_map, state, lanes) or changed
 
-                update_weight_by_popularity(graph, vertex, road_map)
+            # Searches are only redone once the weights moved past the cache tolerance
+            if changed and shortest_paths is not None and route_cache.stale(graph, shortest_path[1]):
+                shortest_paths.update()
 
-            acumulated_context.append(context_metrics)
+            routes.append(list(shortest_path[1]))
             # except Exception, e:
             #     error_count+=1
 
+    fill_skipped_metrics(road_map, routes, contextual, step)
+
+    for route in routes:
+
+        context_metrics = {'traffic': 0, 'crimes': 0, 'crashes': 0}
+        for vertex in route:
+            context_metrics['traffic'] += road_map[vertex]['traffic']
+            context_metrics['crimes'] += road_map[vertex]['crimes']
+            context_metrics['crashes'] += road_map[vertex]['crashes']
+
+        acumulated_context.append(context_metrics)
+
     return error_count, total_count, acumulated_context
 
@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+
+from timewindow.binnedkde import compare
+
+
+# Largest difference allowed between the normalized surfaces, scores are in [0, 1]
+TOLERANCE = 0.01
+
+# Sizes of the samples, from a quiet window to a busy one
+SIZES = [50, 1000, 20000]
+
+
+def uniform(rng, size):
+	return rng.rand(2, size) * [[0.1], [0.1]] + [[41.8], [-87.7]]
+
+
+def hotspot(rng, size):
+
+	# Half of the incidents around one corner, the others spread over the area
+	spot = rng.randn(2, size // 2) * 0.002 + [[41.85], [-87.65]]
+	spread = rng.rand(2, size - size // 2) * 0.1 + [[41.8], [-87.7]]
+
+	return np.hstack([spot, spread])
+
+
+def correlated(rng, size):
+
+	points = rng.randn(2, size) * 0.01
+	points[1] += points[0] * 0.9
+
+	return points + [[41.8], [-87.7]]
+
+
+class CompareTest(unittest.TestCase):
+
+	def check(self, sample, seed):
+
+		for size in SIZES:
+			dataset = sample(np.random.RandomState(seed), size)
+			self.assertLess(compare(dataset), TOLERANCE, '{0} of {1} points'.format(sample.__name__, size))
+
+
+	def test_uniform(self):
+		self.check(uniform, 0)
+
+
+	def test_hotspot(self):
+		self.check(hotspot, 1)
+
+
+	def test_correlated(self):
+		self.check(correlated, 2)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,90 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import networkx as nx
+
+from src.cch_mannager import Contraction, CustomizableHierarchy, load_contraction
+
+
+# Largest difference allowed between route costs, sums of the same weights in another order
+TOLERANCE = 1e-9
+
+
+def random_graph(seed, size=300, degree=3., ties=False):
+
+	# Sparse random roads, some of them out of reach of the others
+	rng = np.random.RandomState(seed)
+	graph = nx.gnp_random_graph(size, degree / size, seed=seed, directed=True)
+
+	for source, target in graph.edges():
+		graph.adj[source][target]['weight'] = float(rng.randint(1, 4)) if ties else float(rng.uniform(0.01, 2))
+
+	return nx.relabel_nodes(graph, dict((node, 'road{0}'.format(node)) for node in graph.nodes()))
+
+
+class HierarchyTest(unittest.TestCase):
+
+	def check(self, graph, hierarchy, seed, queries=300):
+
+		rng = np.random.RandomState(seed)
+		nodes = list(graph.nodes())
+
+		for _ in range(queries):
+			source, destination = nodes[rng.randint(len(nodes))], nodes[rng.randint(len(nodes))]
+
+			try:
+				expected = nx.bidirectional_dijkstra(graph, source, destination)[0]
+			except nx.NetworkXNoPath:
+				self.assertRaises(nx.NetworkXNoPath, hierarchy.path, source, destination)
+				continue
+
+			length, path = hierarchy.path(source, destination)
+			cost = sum(graph.adj[road][next_road]['weight'] for road, next_road in zip(path[:-1], path[1:]))
+
+			self.assertEqual((path[0], path[-1]), (source, destination))
+			self.assertLess(abs(length - expected), TOLERANCE)
+			self.assertLess(abs(cost - expected), TOLERANCE)
+
+
+	def test_costs(self):
+
+		for seed in range(4):
+			graph = random_graph(seed, ties=seed % 2 == 1)
+			self.check(graph, CustomizableHierarchy(graph, Contraction.build(graph)), seed)
+
+
+	def test_update(self):
+
+		# Customized again after the weights change, the contraction is kept
+		graph = random_graph(4)
+		hierarchy = CustomizableHierarchy(graph, Contraction.build(graph))
+
+		rng = np.random.RandomState(4)
+		for source, target in graph.edges():
+			graph.adj[source][target]['weight'] *= rng.uniform(0.5, 4)
+
+		hierarchy.update()
+		self.check(graph, hierarchy, 4)
+
+
+	def test_saved(self):
+
+		graph = random_graph(5, size=100)
+		folder = tempfile.mkdtemp()
+
+		try:
+			network = folder + '/net.xml'
+			with open(network, 'w') as net:
+				net.write('<net/>')
+
+			load_contraction(graph, network, folder=folder)
+			self.check(graph, CustomizableHierarchy(graph, load_contraction(graph, network, folder=folder)), 5)
+
+		finally:
+			shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+	unittest.main()
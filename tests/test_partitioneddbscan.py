@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+from timewindow.partitioneddbscan import PartitionedDBSCAN
+
+
+EPS = 0.01
+
+# From tiles barely wider than the halo up to a single tile
+TILES = [0.021, 0.03, 0.07, None]
+
+
+def city_points(seed, size=4000):
+
+	# Scattered incidents, a few dense spots and repeated addresses
+	rng = np.random.RandomState(seed)
+
+	scattered = rng.rand(size, 2) * 0.3
+	spots = np.vstack([rng.randn(size // 8, 2) * 0.004 + center for center in rng.rand(4, 2) * 0.3])
+	points = np.vstack([scattered, spots])
+
+	return np.vstack([points, points[rng.randint(len(points), size=size // 4)]])
+
+
+class PartitionedDBSCANTest(unittest.TestCase):
+
+	def check(self, points, min_samples, jobs=1):
+
+		exact = DBSCAN(eps=EPS, min_samples=min_samples).fit_predict(points)
+
+		for tile in TILES:
+			labels = PartitionedDBSCAN(eps=EPS, min_samples=min_samples, tile=tile, jobs=jobs).fit_predict(points)
+			self.assertTrue(np.array_equal(labels, exact), 'tile {0}, min_samples {1}'.format(tile, min_samples))
+
+
+	def test_labels(self):
+
+		for seed in range(3):
+			for min_samples in (3, 5):
+				self.check(city_points(seed), min_samples)
+
+
+	def test_duplicates(self):
+
+		# Every point repeated, min_samples reached by copies alone
+		points = np.repeat(city_points(3, size=500), 3, axis=0)
+		self.check(points, 3)
+
+
+	def test_pool(self):
+		self.check(city_points(4), 3, jobs=2)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from timewindow.contextmapping import ContextMapping
+from timewindow.contextual import fit_kernel
+from timewindow.scenariobox import ScenarioBox, SCENARIOS
+
+
+# Largest difference allowed between exact scores inside the box, scores are in [0, 1]
+TOLERANCE = 1e-3
+
+
+def city_points(seed, size=3000):
+
+	# Incidents over the whole city with a hotspot next to the Loop
+	rng = np.random.RandomState(seed)
+
+	uniform = np.column_stack([rng.uniform(41.64, 42.02, size), rng.uniform(-87.94, -87.52, size)])
+	hotspot = rng.multivariate_normal([41.885, -87.64], [[1e-5, 0], [0, 1e-5]], size // 3)
+
+	return np.vstack([uniform, hotspot])
+
+
+def box_grid(box, size=30):
+
+	lats, lons = np.meshgrid(np.linspace(box.bottom, box.top, size), np.linspace(box.left, box.right, size))
+	return np.vstack([lats.ravel(), lons.ravel()])
+
+
+def scores(fitted, positions):
+
+	kernel, mini, maxi, _ = fitted
+	return (kernel.pdf(positions) - mini) / (maxi - mini)
+
+
+class CropTest(unittest.TestCase):
+
+	def setUp(self):
+
+		(top, left), (bottom, right) = SCENARIOS['chicago']
+
+		self.mapping = ContextMapping()
+		self.mapping.boxes = {'chicago': ScenarioBox(top, left, bottom, right, margin=0.02)}
+
+		self.inside = box_grid(ScenarioBox(top, left, bottom, right, margin=0))
+
+
+	def crop(self, points):
+
+		# The window as cm writes it, cropped with the kernel statistics of the whole one
+		output_data = {'crimes_chicago': {'THEFT': {'0': points.tolist()}}}
+		stats = self.mapping.crop(output_data, {})
+
+		return np.asarray(output_data['crimes_chicago']['THEFT']['0']), stats[('crimes_chicago', 'THEFT', '0')]
+
+
+	def test_points(self):
+
+		for seed in range(3):
+			points = city_points(seed)
+			cropped, whole = self.crop(points)
+
+			self.assertLess(len(cropped), len(points))
+
+			for kde in ('gaussian', 'binned'):
+				exact = scores(fit_kernel(points, kde=kde), self.inside)
+				box = scores(fit_kernel(cropped, kde=kde, whole=whole), self.inside)
+
+				# Binned surfaces also move with the grid their points span
+				self.assertLess(np.abs(exact - box).max(), TOLERANCE if kde == 'gaussian' else 0.02)
+
+
+	def test_summary(self):
+
+		self.mapping.summary = True
+
+		for seed in range(3):
+			points = city_points(seed)
+
+			# One cluster per cell of a 0.02 degree grid
+			cells = np.floor(points / 0.02).astype(int)
+			labels = np.unique(cells, axis=0, return_inverse=True)[1]
+			order = np.argsort(labels, kind='mergesort')
+
+			data = pd.DataFrame({'lat': points[order, 0], 'lon': points[order, 1], 'cluster': labels[order]})
+			clusters = np.asarray(self.mapping.format_summary(data))
+
+			cropped, whole = self.crop(clusters)
+
+			self.assertLess(len(cropped), len(clusters))
+
+			exact = scores(fit_kernel(clusters, summary=True), self.inside)
+			box = scores(fit_kernel(cropped, summary=True, whole=whole), self.inside)
+
+			self.assertLess(np.abs(exact - box).max(), TOLERANCE)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,121 @@
+import numpy as np
+from scipy import stats
+from scipy.signal import fftconvolve
+
+from .riskraster import bilinear
+
+
+# Internal grid spacing as a fraction of the kernel standard deviation along its narrowest axis
+SPACING = 1. / 4
+
+# Nodes along each side of the internal grid are kept within these limits
+MIN_NODES, MAX_NODES = 64, 512
+
+# Kernels are truncated at this many standard deviations
+TRUNCATE = 4.
+
+
+class BinnedKDE:
+
+	'''
+		Gaussian KDE with the same Scott bandwidth as scipy's gaussian_kde, points are
+		linearly binned on a grid and convolved with the kernel by FFT, so fitting costs
+		O(points + grid log grid) and pdf is a bilinear lookup
+	'''
+
+	def __init__(self, dataset, covariance=None, total=None):
+
+		self.dataset = np.atleast_2d(np.asarray(dataset, dtype=float))
+		self.d, self.n = self.dataset.shape
+
+		# Same covariance and factor as gaussian_kde, also failing on degenerate data
+		if covariance is None:
+			self.factor = self.n ** (-1. / (self.d + 4))
+			self.covariance = np.atleast_2d(np.cov(self.dataset)) * self.factor ** 2
+		else:
+			self.covariance = np.atleast_2d(covariance)
+
+		self.inv_cov = np.linalg.inv(self.covariance)
+
+		# Points cropped from a larger window keep their weight in it
+		self.total = total if total is not None else self.n
+
+		self.fit()
+
+
+	def fit(self):
+
+		std = np.sqrt(np.diag(self.covariance))
+		lower = self.dataset.min(axis=1) - TRUNCATE * std
+		upper = self.dataset.max(axis=1) + TRUNCATE * std
+
+		# Nodes of the grid along each axis, spacing a fraction of the narrowest kernel axis
+		narrowest = np.sqrt(np.linalg.eigvalsh(self.covariance).min())
+		nodes = np.clip(np.ceil((upper - lower) / (narrowest * SPACING)).astype(int) + 1, MIN_NODES, MAX_NODES)
+		step = (upper - lower) / (nodes - 1)
+
+		self.extent = [lower[0], upper[0], lower[1], upper[1]]
+		self.density = fftconvolve(self.bin(lower, step, nodes), self.kernel(step), mode='same')
+
+
+	def bin(self, lower, step, nodes):
+
+		# Linear binning, each point is split among its four nearest nodes
+		position = (self.dataset - lower[:, None]) / step[:, None]
+		cell = np.minimum(np.floor(position).astype(int), (nodes - 2)[:, None])
+		frac = position - cell
+
+		counts = np.zeros(nodes)
+		for dx in (0, 1):
+			for dy in (0, 1):
+				weight = (frac[0] if dx else 1 - frac[0]) * (frac[1] if dy else 1 - frac[1])
+				np.add.at(counts, (cell[0] + dx, cell[1] + dy), weight)
+
+		return counts / self.total
+
+
+	def kernel(self, step):
+
+		std = np.sqrt(np.diag(self.covariance))
+		half = np.ceil(TRUNCATE * std / step).astype(int)
+
+		X, Y = np.meshgrid(np.arange(-half[0], half[0] + 1) * step[0], np.arange(-half[1], half[1] + 1) * step[1], indexing='ij')
+		offsets = np.vstack([X.ravel(), Y.ravel()])
+
+		distance = np.sum(offsets * np.dot(self.inv_cov, offsets), axis=0)
+		norm = 2 * np.pi * np.sqrt(np.linalg.det(self.covariance))
+
+		return (np.exp(-0.5 * distance) / norm).reshape(X.shape)
+
+
+	def pdf(self, points):
+
+		# Points as gaussian_kde takes them, (2, m) or a single [(lat, lon)]
+		points = np.atleast_2d(np.asarray(points, dtype=float))
+		if points.shape[0] != self.d:
+			points = points.reshape(self.d, -1)
+
+		return np.maximum(bilinear(self.density, self.extent, points[0], points[1]), 0.0)
+
+	__call__ = pdf
+
+
+def compare(dataset, size=100):
+
+	'''
+		Largest difference between the normalized surfaces of gaussian_kde and BinnedKDE
+		on the size x size grid create_kde uses, scores are in [0, 1]. tests/test_binnedkde.py
+		keeps it below 0.01 for uniform, hotspot and correlated samples of 50 up to 20000 points.
+	'''
+
+	dataset = np.asarray(dataset, dtype=float)
+	X, Y = np.mgrid[dataset[0].min():dataset[0].max():size * 1j, dataset[1].min():dataset[1].max():size * 1j]
+	positions = np.vstack([X.ravel(), Y.ravel()])
+
+	exact = stats.gaussian_kde(dataset)(positions)
+	binned = BinnedKDE(dataset)(positions)
+
+	exact = (exact - exact.min()) / (exact.max() - exact.min())
+	binned = (binned - binned.min()) / (binned.max() - binned.min())
+
+	return np.abs(exact - binned).max()
@@ -1,8 +1,12 @@
 import numpy as np
 import pandas as pd
 import os
+import itertools
+import multiprocessing as mp
 from os import listdir
 
+from .incidentstore import IncidentStore
+
 
 FILTERS = {
 			'austin_crashes_2018.csv': 
@@ -18,22 +22,45 @@ FILTERS = {
 				{'columns': ['Date', 'Type', 'Latitude', 'Longitude'],\
 				'types': [str, str, float, float],\
 				'positions': [2, 9, 46, 47],\
-				'ignore_nan': [0, 0, 0, 0]},
+				'ignore_nan': [0, 0, 0, 0],\
+				'date_format': '%m/%d/%Y %I:%M:%S %p'},
 
 			'chicago_crimes_2018.csv':
 				{'columns': ['Date', 'Type', 'Latitude', 'Longitude'],\
 				'types': [str, str, float, float],\
 				'positions': [1, 4, 14, 15],\
-				'ignore_nan': [0, 0, 0, 0]}
+				'ignore_nan': [0, 0, 0, 0],\
+				'date_format': '%m/%d/%Y %I:%M:%S %p'}
 }
 
+# Bytes read per chunk by the streaming cleaner
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Characters removed by str.strip()
+BLANKS = np.frombuffer(b' \t\n\r\x0b\x0c', dtype=np.uint8)
+
 
 class CleanData:
 
 
-	def __init__(self, old_separator=',', new_separator='\t'):
+	def __init__(self, old_separator=',', new_separator='\t', chunk_size=CHUNK_SIZE):
 		self.old_separator = old_separator
 		self.new_separator = new_separator
+		self.chunk_size = chunk_size
+
+
+	def find_filter(self, file):
+
+		if file in FILTERS:
+			return FILTERS[file]
+
+		# New batches of a dataset, e.g. chicago_crimes_2018_w42.csv, share its filter
+		prefix = '_'.join(file.split('.')[0].split('_')[:2]) + '_'
+		for name in sorted(FILTERS):
+			if name.startswith(prefix):
+				return FILTERS[name]
+
+		raise KeyError(file)
 
 
 	def read_data(self, file, data_header):
@@ -79,32 +106,299 @@ class CleanData:
 		return data_cleaned
 
 
-	def read_data_folder(self, folder='./data/input/'):
+	def count_fields(self, file):
+
+		with open(file, 'rb') as data_file:
+			header = data_file.readline().strip()
+
+		# Same rule as read_data, valid rows have one field more than the header
+		return len(header.split(self.old_separator)) + 1
+
+
+	def byte_ranges(self, file):
+
+		total = os.path.getsize(file)
+		ranges = []
+
+		with open(file, 'rb') as data_file:
+			start = 0
+			while start < total:
+				data_file.seek(min(start + self.chunk_size, total))
+
+				# Complete the last line so no row is split between ranges
+				data_file.readline()
+				end = data_file.tell()
+
+				ranges.append((start, end))
+				start = end
+
+		return ranges
+
+
+	def read_range(self, file, start, end):
+
+		with open(file, 'rb') as data_file:
+			data_file.seek(start)
+			return data_file.read(end - start)
+
+
+	def split_fields(self, block, size, positions):
+
+		if not block.endswith(b'\n'):
+			block += b'\n'
+
+		data = np.frombuffer(block, dtype=np.uint8)
+
+		separators = np.flatnonzero(data == ord(self.old_separator))
+		ends = np.flatnonzero(data == ord('\n'))
+		starts = np.concatenate(([0], ends[:-1] + 1))
+
+		# Same rule as read_data, keep the lines with exactly size fields
+		bounds = np.searchsorted(separators, ends)
+		counts = np.diff(np.concatenate(([0], bounds)))
+		keep = counts == size - 1
+
+		if not keep.any():
+			return None
+
+		first = (bounds - counts)[keep]
+		starts, ends = starts[keep], ends[keep]
+
+		# read_data strips the whole line before splitting it
+		if 0 in positions or size - 1 in positions:
+			self.strip_lines(data, starts, ends)
+
+		fields = {}
+
+		for position in set(positions):
+			field_start = starts if position == 0 else separators[first + position - 1] + 1
+			field_end = ends if position == size - 1 else separators[first + position]
+
+			fields[position] = self.extract_field(data, field_start, field_end)
+
+		return fields
+
+	def strip_lines(self, data, starts, ends):
+
+		is_blank = np.isin(data, BLANKS)
+
+		while True:
+			move = (starts < ends) & is_blank[starts]
+			if not move.any():
+				break
+			starts[move] += 1
+
+		while True:
+			move = (ends > starts) & is_blank[ends - 1]
+			if not move.any():
+				break
+			ends[move] -= 1
+
+
+	def extract_field(self, data, starts, ends):
+
+		widths = ends - starts
+		width = max(int(widths.max()), 1)
+
+		offsets = np.arange(width)
+		inside = offsets < widths[:, None]
+
+		field = data[np.minimum(starts[:, None] + offsets, len(data) - 1)]
+		field[~inside] = 0
+
+		# Same checks as read_data, blank or exactly '0'
+		blank = ~(inside & ~np.isin(field, BLANKS)).any(axis=1)
+		zero = (widths == 1) & (field[:, 0] == ord('0'))
+
+		return field.view('S{0}'.format(width)).ravel(), blank | zero
+
+	def clean_chunk(self, fields, data_header):
+
+		alive = None
+		converted = {}
+
+		for indx, column in enumerate(data_header['columns']):
+
+			position = data_header['positions'][indx]
+			column_type = data_header['types'][indx]
+			ignore_nan = data_header['ignore_nan'][indx]
+
+			values, empty = fields[position]
+
+			if alive is None:
+				alive = np.ones(len(values), dtype=bool)
+
+			if not ignore_nan:
+				alive &= ~empty
+
+			try:
+				converted[column] = (alive.copy(), values[alive].astype(column_type))
+
+			except ValueError:
+				for value in values[alive]:
+					try:
+						column_type(value)
+					except ValueError:
+						raise Exception('Invalid data type at column {0}, data {1}, expected type {2}.'.format(column, value, column_type))
+
+		data_cleaned = {}
+
+		for column in converted:
+			converted_alive, values = converted[column]
+			data_cleaned[column] = values[alive[converted_alive]]
+
+		return pd.DataFrame(data_cleaned, columns=sorted(data_cleaned))
+
+
+	def clean_range(self, file, data_header, size, start, end):
+
+		fields = self.split_fields(self.read_range(file, start, end), size, data_header['positions'])
+
+		if fields is None:
+			return None
+
+		return self.clean_chunk(fields, data_header)
+
+
+	def read_data_chunked(self, file, data_header):
+
+		size = self.count_fields(file)
+
+		for start, end in self.byte_ranges(file):
+			chunk = self.clean_range(file, data_header, size, start, end)
+
+			if chunk is not None:
+				yield chunk
+
+
+	def write_chunks(self, chunks, file, data_header, output, store=None):
+
+		header = True
+
+		with open(output, 'w') as output_file:
+			for chunk in chunks:
+				if chunk is None:
+					continue
+
+				# Fields are already utf-8 bytes, no encoding writer is needed
+				chunk.to_csv(output_file, sep=self.new_separator, index=False, header=header)
+				header = False
+
+				if store is not None:
+					store.append(os.path.basename(file), chunk, date_format=data_header.get('date_format'))
+
+			if header:
+				output_file.write(self.new_separator.join(sorted(data_header['columns'])) + '\n')
+
+
+	def clean_file(self, file, data_header, output, store=None):
+		self.write_chunks(self.read_data_chunked(file, data_header), file, data_header, output, store=store)
+
+
+	def clean_folder(self, folder='./data/input/', output_folder='./data/cleaned/', store=None, jobs=1, skip=()):
+
+		files = [file for file in sorted(listdir(folder)) if not file.startswith('.') and file not in skip]
+
+		if jobs <= 1:
+			for file in files:
+				print('! File: {0}'.format(file))
+				self.clean_file(folder + file, self.find_filter(file), output_folder + 'cleaned_' + file, store=store)
+
+				if store is not None:
+					store.mark_ingested(file)
+			return
+
+		# Every byte range of every file is a task, results come back in task order
+		# with at most two tasks per process in flight, so memory stays bounded
+		tasks, counts = [], []
+		for file in files:
+			size = self.count_fields(folder + file)
+			ranges = self.byte_ranges(folder + file)
+
+			tasks += [(self, folder + file, self.find_filter(file), size, start, end) for start, end in ranges]
+			counts.append(len(ranges))
+
+		pool = mp.Pool(jobs)
+
+		try:
+			chunks = bounded_imap(pool, clean_range, tasks, 2 * jobs)
+
+			for indx, file in enumerate(files):
+				print('! File: {0}'.format(file))
+				self.write_chunks(itertools.islice(chunks, counts[indx]), folder + file, self.find_filter(file), output_folder + 'cleaned_' + file, store=store)
+
+				if store is not None:
+					store.mark_ingested(file)
+
+		finally:
+			pool.close()
+			pool.join()
+
+
+	def read_data_folder(self, folder='./data/input/', skip=()):
 
 		dfs = {}
 
 		for file in listdir(folder):
-			if file.startswith('.'): continue
-			dfs[str(file)] = self.read_data(folder + file, FILTERS[file])
+			if file.startswith('.') or file in skip: continue
+			dfs[str(file)] = self.read_data(folder + file, self.find_filter(file))
 
 		return dfs
 
 
-	def write_files(self, files):
+	def write_files(self, files, store=None):
 
 		for file in files:
 			files[file].to_csv('./data/cleaned/cleaned_' + file, sep=self.new_separator, encoding='utf-8', index=False)
 
+			if store is not None:
+				store.append(file, files[file], date_format=self.find_filter(file).get('date_format'))
+				store.mark_ingested(file)
+
+
+	def main(self, streaming=True, jobs=1, incremental=False):
 
-	def main(self):
-		
 		print('!# Begin')
 
-		print('! Read input files')
-		files = self.read_data_folder()
+		store = IncidentStore()
+
+		# Incremental runs append only the input files the store has not seen
+		skip = store.ingested() if incremental else []
+		if not incremental:
+			store.clear()
+
+		if streaming:
+			print('! Clean input files by chunks')
+			self.clean_folder(store=store, jobs=jobs, skip=skip)
+
+		else:
+			print('! Read input files')
+			files = self.read_data_folder(skip=skip)
+
+			print('! Write output files')
+			self.write_files(files, store=store)
 
-		print('! Write output files')
-		self.write_files(files)
-		
 		print('!# End')
 
+
+
+def clean_range(task):
+
+	# Pool workers can not receive bound methods on python 2
+	cleaner, file, data_header, size, start, end = task
+	return cleaner.clean_range(file, data_header, size, start, end)
+
+
+def bounded_imap(pool, function, tasks, window):
+
+	# Like pool.imap, but a task is only submitted once the result window before it was consumed
+	pending = []
+
+	for task in tasks:
+		pending.append(pool.apply_async(function, (task,)))
+
+		if len(pending) >= window:
+			yield pending.pop(0).get()
+
+	while pending:
+		yield pending.pop(0).get()
@@ -0,0 +1,139 @@
+import os
+import json
+
+import numpy as np
+
+
+# Every clustered point is stored as (lat, lon)
+DTYPE = 'float64'
+
+# Cluster summaries are stored as (count, lat, lon, cov lat lat, cov lat lon, cov lon lon,
+# min lat, min lon, max lat, max lon)
+SUMMARY_WIDTH = 10
+
+
+class ContextMap:
+
+	'''
+		Binary context map of a day, the points of every (city, context, type, window)
+		are a contiguous block of <day>.bin and <day>.index.json keeps their offsets.
+		With summary the blocks hold one row per cluster at <day>.summary.bin. Maps
+		cropped to a scenario box also keep the kernel_stats of every whole window
+	'''
+
+	def __init__(self, folder='./data/mapped/', summary=False):
+		self.folder = folder
+		self.summary = summary
+
+		self.suffix = '.summary' if summary else ''
+		self.width = SUMMARY_WIDTH if summary else 2
+
+
+	def data_file(self, day):
+		return os.path.join(self.folder, str(day) + self.suffix + '.bin')
+
+
+	def index_file(self, day):
+		return os.path.join(self.folder, str(day) + self.suffix + '.index.json')
+
+
+	def exists(self, day):
+		return os.path.exists(self.index_file(day)) and os.path.exists(self.data_file(day))
+
+
+	def split_key(self, key):
+
+		# crimes_chicago -> ('chicago', 'crimes')
+		parts = key.split('_')
+		return parts[1] if len(parts) > 1 else parts[0], parts[0]
+
+
+	def write(self, output_data, day, stats=None):
+
+		if not os.path.exists(self.folder):
+			os.makedirs(self.folder)
+
+		index = {}
+		offset = 0
+
+		with open(self.data_file(day), 'wb') as data_file:
+			for key in sorted(output_data):
+
+				city, _ = self.split_key(key)
+				blocks = index.setdefault(city, {}).setdefault(key, {})
+
+				for crime in sorted(output_data[key]):
+
+					blocks[crime] = {}
+
+					for window in sorted(output_data[key][crime], key=int):
+
+						points = np.asarray(output_data[key][crime][window], dtype=DTYPE).reshape(-1, self.width)
+						points.tofile(data_file)
+
+						# [offset, rows] or [offset, rows, kernel_stats...] of a cropped window
+						blocks[crime][window] = [offset, len(points)]
+						if stats is not None and stats.get((key, crime, window)) is not None:
+							blocks[crime][window] += stats[(key, crime, window)]
+
+						offset += len(points)
+
+		with open(self.index_file(day), 'w') as index_file:
+			json.dump({'dtype': DTYPE, 'width': self.width, 'points': offset, 'cities': index}, index_file, indent=4)
+
+
+	def load(self, day, city=None):
+
+		with open(self.index_file(day), 'r') as index_file:
+			index = json.load(index_file)
+
+		# Without city every context key of the day is loaded
+		if city is None:
+			blocks = {}
+			for city_blocks in index['cities'].values():
+				blocks.update(city_blocks)
+		else:
+			blocks = index['cities'].get(city, {})
+
+		# Nothing is read here, pages of a block are only loaded when it is used
+		if index['points'] > 0:
+			points = np.memmap(self.data_file(day), dtype=index['dtype'], mode='r', shape=(index['points'], index['width']))
+		else:
+			points = np.empty((0, index['width']), dtype=index['dtype'])
+
+		context_data = {}
+		for key in blocks:
+			context_data[str(key)] = dict((str(crime), WindowBlocks(points, blocks[key][crime])) for crime in blocks[key])
+
+		return context_data
+
+
+class WindowBlocks(dict):
+
+	'''
+		Windows of one type, the points are sliced from the memory map the first time a window is accessed
+	'''
+
+	def __init__(self, points, blocks):
+		dict.__init__(self, ((str(window), None) for window in blocks))
+		self.points = points
+		self.blocks = blocks
+
+
+	def __getitem__(self, window):
+
+		points = dict.__getitem__(self, window)
+
+		if points is None:
+			offset, count = self.blocks[window][:2]
+			points = self.points[offset:offset + count]
+			dict.__setitem__(self, window, points)
+
+		return points
+
+
+	def stats(self, window):
+
+		# kernel_stats of the whole window, None when the map was not cropped
+		block = self.blocks.get(window)
+		return block[2:] if block is not None and len(block) > 2 else None
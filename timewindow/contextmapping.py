@@ -3,30 +3,88 @@ import numpy as np
 import os, sys
 from os import listdir
 import json
+import multiprocessing as mp
 
 from scipy.signal import find_peaks, savgol_filter, hilbert, wiener
 from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+from scipy import sparse
 import matplotlib.pyplot as plt
 from .plotter import Plotter
+from .incidentstore import IncidentStore
+from .contextmap import ContextMap, SUMMARY_WIDTH
+from .contextual import kernel_bandwidth, kernel_stats
+from .cleandata import CleanData
+from .partitioneddbscan import PartitionedDBSCAN
+from .scenariobox import find_box, MARGIN
+
+
+DAYS = ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday']
+
+# Daily incident frames inherited by the forked workers
+SHARED = {}
 
 
 class Clustering:
 
 
+	def __init__(self, jobs=1, partition_size=20000):
+		self.jobs = jobs
+
+		# Windows above this size are clustered by tiles instead of a neighbor graph
+		self.partition_size = partition_size
+
+
+	def is_large(self, size):
+		return size > self.partition_size
+
+
 	def encode(self, data):
-		data = data.drop(['type', 'hour', 'minute', 'dayofweek'], axis=1)
-		return data
+		return data[['lat', 'lon']]
 
 
 	def clusterize(self, data, ep=0.01):
 
-		data_formated = self.encode(data.copy())
+		data_formated = self.encode(data)
 		clustering = DBSCAN(eps=ep, min_samples=3).fit_predict(data_formated)
-		data['cluster'] = clustering
+		data = data.assign(cluster=clustering)
 		
 		return data.sort_values('cluster')
 
 
+	def neighbor_graph(self, data, bounds, radius):
+
+		# Neighbors are only searched inside each [bounds[k], bounds[k + 1]) block of rows
+		points = self.encode(data).values
+		blocks = []
+
+		for start, end in zip(bounds[:-1], bounds[1:]):
+			if self.is_large(end - start):
+				blocks.append(sparse.csr_matrix((end - start, end - start)))
+				continue
+
+			tree = NearestNeighbors(radius=radius, algorithm='ball_tree').fit(points[start:end])
+			blocks.append(tree.radius_neighbors_graph(points[start:end], mode='distance'))
+
+		return sparse.block_diag(blocks, format='csr')
+
+
+	def clusterize_partitioned(self, data, ep=0.01, min_samples=3):
+
+		clustering = PartitionedDBSCAN(eps=ep, min_samples=min_samples, jobs=self.jobs).fit_predict(self.encode(data).values)
+		data = data.assign(cluster=clustering)
+
+		return data.sort_values('cluster')
+
+
+	def clusterize_graph(self, data, graph, ep=0.01, min_samples=3):
+
+		clustering = DBSCAN(eps=ep, min_samples=min_samples, metric='precomputed').fit_predict(graph)
+		data = data.assign(cluster=clustering)
+
+		return data.sort_values('cluster')
+
+
 class ContextMapping:
 
 	crimes_chicago = ['ASSAULT', 'BATTERY', 'BURGLARY', 'CRIMINAL DAMAGE', 
@@ -54,36 +112,118 @@ class ContextMapping:
 
 		self.plotter = Plotter()
 
+		self.score_kernel = None
+
+		# Emit one summary row per cluster instead of the clustered points
+		self.summary = False
+
+		# Scenario box of each city, None maps the whole city
+		self.boxes = None
+		self.margin = MARGIN
+
 	def remove_invalid_coord(self, df):
-		return df.query('lat != 0 & lon != 0')
+		return df[(df['lat'].values != 0) & (df['lon'].values != 0)]
 
 
-	def read_data(self, folder, file):
+	def find_box(self, city):
+
+		if city not in self.boxes:
+			self.boxes[city] = find_box(city, margin=self.margin)
+
+		return self.boxes[city]
 
-		data_file = open(folder + file, 'r')
 
-		context_list = []
+	def crop(self, output_data, stats):
 
-		for line in data_file:
-			line = line.strip().split('\t')
+		'''
+			Windows clustered from every incident of the city are cropped to the
+			scenario box, grown to the reach of their kernel, before they are written.
+			The kernel_stats of each whole window are kept so kernels fitted over the
+			cropped points score as the whole one, windows with nothing left skip them.
+			Windows already in stats were cropped by an earlier mapping
+		'''
 
-			item = {}
-			item['datetime'] = pd.to_datetime(str(line[0]))
-			item['hour'] = pd.to_datetime(str(line[0])).hour
-			item['minute'] = pd.to_datetime(str(line[0])).minute
-			item['lat'] = float(line[1])
-			item['lon'] = float(line[2])
-			item['type'] = line[3].strip().split()[0]
+		if self.boxes is None:
+			return None
 
-			context_list.append(item)
+		width = SUMMARY_WIDTH if self.summary else 2
 
-		data_file.close()
+		for key in output_data:
 
-		df = pd.DataFrame(context_list)
-		df['dayofweek'] = df['datetime'].dt.dayofweek
-		df.set_index('datetime', inplace=True)
+			box = self.find_box(self.key_city(key))
+			if box is None:
+				continue
 
-		return self.remove_invalid_coord(df)
+			for crime in output_data[key]:
+				for window in output_data[key][crime]:
+
+					if (key, crime, window) in stats:
+						continue
+
+					points = np.asarray(output_data[key][crime][window], dtype=float).reshape(-1, width)
+
+					bandwidth = kernel_bandwidth(points, summary=self.summary)
+
+					# Points within a few bandwidths of the box still add to the scores inside
+					reach = box.reach(max(bandwidth[0, 0], bandwidth[1, 1])) if bandwidth is not None else box
+					cropped = reach.crop_summary(points) if self.summary else reach.crop_points(points)
+
+					stats[(key, crime, window)] = kernel_stats(points, summary=self.summary) if len(cropped) > 0 else None
+					output_data[key][crime][window] = cropped
+
+		return stats
+
+
+	def key_city(self, key):
+
+		# crimes_chicago -> chicago
+		return key.split('_')[1]
+
+
+	def boxes_state(self):
+
+		if self.boxes is None:
+			return None
+
+		return dict((city, box.bounds()) for city, box in self.boxes.items() if box is not None)
+
+
+	def date_format(self, file):
+
+		# Weekly batches take the filter of their dataset, the same one the cleaner used
+		try:
+			data_header = CleanData().find_filter(file.replace('cleaned_', '', 1))
+		except KeyError:
+			return None
+
+		if isinstance(data_header, dict):
+			return data_header.get('date_format')
+
+
+	def read_data(self, folder, file):
+
+		with open(folder + file, 'r') as data_file:
+			has_header = data_file.readline().split('\t')[0].strip() == 'Date'
+
+		data = pd.read_csv(folder + file, sep='\t', header=None, skiprows=int(has_header),
+						names=['datetime', 'lat', 'lon', 'type'], dtype={'datetime': str, 'type': 'category'},
+						float_precision='round_trip')
+
+		# Parse the whole column once, same results as one to_datetime per line
+		dates = pd.to_datetime(data['datetime'].str.strip(), format=self.date_format(file), cache=True)
+
+		df = pd.DataFrame({
+			'hour': dates.dt.hour.values.astype(np.int8),
+			'lat': data['lat'].values,
+			'lon': data['lon'].values,
+			'minute': dates.dt.minute.values.astype(np.int8),
+			'type': data['type'].map(lambda t: t.strip().split()[0]).astype('category').values,
+			'dayofweek': dates.dt.dayofweek.values.astype(np.int8)
+		}, columns=['hour', 'lat', 'lon', 'minute', 'type', 'dayofweek'], index=pd.DatetimeIndex(dates, name='datetime'))
+
+		df['minute_of_day'] = df['hour'].values.astype(np.int16) * 60 + df['minute'].values
+
+		return self.sort_incidents(self.remove_invalid_coord(df))
 
 
 	def read_data_folder(self):
@@ -91,17 +231,50 @@ class ContextMapping:
 		dfs = {}
 
 		folder = './data/cleaned/'
-		for file in listdir(folder):
+		for file in sorted(listdir(folder)):
 			print('! File: {0}'.format(file))
-			dfs[file] = self.read_data(folder, file)
+
+			# cleaned_chicago_crimes_2018.csv -> crimes_chicago, the same keys the incident store gives
+			city, context = IncidentStore().split_name(file.replace('cleaned_', '', 1))
+			key = '{0}_{1}'.format(context, city)
+
+			df = self.read_data(folder, file)
+			if key in dfs:
+				df = pd.concat([dfs[key], df])
+				df['type'] = df['type'].astype(str).astype('category')
+				df = self.sort_incidents(df)
+
+			dfs[key] = df
 
 		return dfs
 
 
+	def read_partition(self, store, city, context, dayofweek):
+		return self.prepare_partition(store.read(city, context, dayofweek))
+
+
+	def prepare_partition(self, df):
+
+		# Same columns as read_data, types are reduced to their first word
+		df['type'] = df['type'].map(lambda t: t.strip().split()[0]).astype('category')
+
+		df['hour'] = (df['minute_of_day'] // 60).astype(np.int8)
+		df['minute'] = (df['minute_of_day'] % 60).astype(np.int8)
+
+		return self.sort_incidents(self.remove_invalid_coord(df))
+
+
+	def sort_incidents(self, df):
+
+		# Sorted by (dayofweek, minute_of_day) so days and windows are contiguous slices
+		key = df['dayofweek'].values.astype(np.int32) * 1440 + df['minute_of_day'].values
+		return df.iloc[np.argsort(key, kind='mergesort')]
+
+
 	def filter_daily(self, df, dayofweek):
 
-		df_filtered = df.query('dayofweek ==' + str(dayofweek))
-		return df_filtered
+		start, end = np.searchsorted(df['dayofweek'].values, [dayofweek, dayofweek + 1])
+		return df.iloc[start:end]
 
 
 	def make_gauss(self, N=1, sig=1, mu=0):
@@ -122,30 +295,52 @@ class ContextMapping:
 
 	def normalize(self, window_scores):
 
+		window_scores = np.asarray(window_scores, dtype=float)
+
 		maxi = np.amax(window_scores)
 		mini = np.amin(window_scores)
 
-		for indx, w in enumerate(window_scores):
-			window_scores[indx] = (w - mini) / (maxi - mini)
+		return (window_scores - mini) / (maxi - mini)
+
+
+	def make_score_kernel(self):
+
+		# Same rounded terms as calculate_difference for every minute offset of a day
+		offsets = np.arange(-1439, 1440)
+		kernel = np.array([self.calculate_difference(0, offset, 0, 0) for offset in offsets])
+
+		# Terms rounded to zero do not contribute
+		half = np.abs(offsets[kernel != 0]).max()
 
-		return window_scores
+		return kernel[1439 - half:1439 + half + 1]
 
 
-	def calculate_score(self, crimes_filtered):
+	def minute_histogram(self, data):
+		return np.bincount(data['minute_of_day'].values, minlength=1440).astype(np.int64)
 
-		window_scores = []
 
-		for hour in range(0, 24):
+	def calculate_score(self, crimes_filtered, slot=10, circular=False):
+		return self.score_histogram(self.minute_histogram(crimes_filtered), slot=slot, circular=circular)
 
-			for minute in range(0, 60, 10):
 
-				state_score = []
-				for index, row in crimes_filtered.iterrows():
-					state_score.append(self.calculate_difference(row['hour'], row['minute'], hour, minute))
+	def score_histogram(self, counts, slot=10, circular=False):
 
-				window_scores.append(np.sum(state_score))
+		if self.score_kernel is None:
+			self.score_kernel = self.make_score_kernel()
 
-		return self.normalize(window_scores)
+		kernel = self.score_kernel
+		half = len(kernel) // 2
+
+		counts = np.asarray(counts, dtype=float)
+
+		# Each minute score sums the kernel of every incident, slots sample every 'slot' minutes
+		if circular:
+			counts = np.concatenate([counts[-half:], counts, counts[:half]])
+			minute_scores = np.convolve(counts, kernel, mode='valid')
+		else:
+			minute_scores = np.convolve(counts, kernel)[half:half + 1440]
+
+		return self.normalize(minute_scores[::slot])
 
 
 	def identify_window(self, window_scores, peaks):
@@ -188,124 +383,279 @@ class ContextMapping:
 
 	def get_window(self, start, end, crimes_filtered):
 
-		start_hour = start * 10 // 60
-		start_minute = start * 10 % 60
+		# Incidents from minute start * 10 up to, not including, minute end * 10
+		start, end = np.searchsorted(crimes_filtered['minute_of_day'].values, [start * 10, end * 10])
+		return crimes_filtered.iloc[start:end]
 
-		end_hour = end * 10 // 60
-		end_minute = end * 10 % 60
 
-		# Filter the closed interval
-		crimes_opened = crimes_filtered.query('hour > {0} & hour < {1}'.format(start_hour, end_hour))
+	def format_data(self, data):
 
-		# Filter the opened interval
-		crimes_closed_low = crimes_filtered.query('hour == {0} & minute >= {1}'.format(start_hour, start_minute))
-		crimes_closed_high = crimes_filtered.query('hour == {0} & minute < {1}'.format(end_hour, end_minute))
+		if data is None:
+			return []
 
-		return pd.concat([crimes_opened, crimes_closed_low, crimes_closed_high])
+		return data[['lat', 'lon']].values.tolist()
 
 
-	def format_data(self, data):
+	def format_summary(self, data):
 
-		if data is None:
+		if data is None or len(data) == 0:
 			return []
 
-		formatted_data = []
+		points = data[['lat', 'lon']].values
+		labels = data['cluster'].values
+
+		# Rows are sorted by cluster, each cluster is a contiguous run
+		starts = np.flatnonzero(np.concatenate(([True], labels[1:] != labels[:-1])))
+		counts = np.diff(np.concatenate((starts, [len(labels)])))
+
+		means = np.add.reduceat(points, starts) / counts[:, None]
+		centered = points - np.repeat(means, counts, axis=0)
 
-		for indx, row in data.iterrows():
-			formatted_data.append((row['lat'], row['lon']))
+		# Biased covariance, the spread of the points around the centroid
+		cov_lat = np.add.reduceat(centered[:, 0] * centered[:, 0], starts) / counts
+		cov_lat_lon = np.add.reduceat(centered[:, 0] * centered[:, 1], starts) / counts
+		cov_lon = np.add.reduceat(centered[:, 1] * centered[:, 1], starts) / counts
 
-		return formatted_data
+		return np.column_stack((counts, means, cov_lat, cov_lat_lon, cov_lon,
+								np.minimum.reduceat(points, starts), np.maximum.reduceat(points, starts))).tolist()
 
 
 	def smooth_scores(self, window_scores):
 		return wiener(window_scores)
 
 
-	def find_window(self, data, clustering, ep=0.01):
+	def find_bounds(self, counts):
 
-		dict_data = {}
-
-		window_scores = self.calculate_score(data)
+		window_scores = self.score_histogram(counts)
 		window_scores = list(self.smooth_scores(window_scores))
 
 		peaks = find_peaks(window_scores, distance=6)[0].tolist()
 
 		if len(peaks) > 0:
-		
-			window = self.identify_window(window_scores, peaks)
+			return self.identify_window(window_scores, peaks)
+
+		return []
 
-			if len(window) > 0:
 
-				iterwindow = iter(window)
-				next(iterwindow)
-				last_window = window[0]
-				for iw in iterwindow:
+	def window_rows(self, data, window):
 
-					data_window = self.get_window(last_window, iw, data)
+		# Rows of each window, same slices as get_window
+		return np.searchsorted(data['minute_of_day'].values, np.array(window) * 10)
 
-					cluster_data = None
-					if len(data_window) >= 3:
-						cluster_data = clustering.clusterize(data_window, ep=ep).query('cluster != -1')
 
-					dict_data[str(last_window)] = self.format_data(cluster_data)
+	def largest_window(self, data):
 
-					last_window = iw
+		rows = self.window_rows(data, self.find_bounds(self.minute_histogram(data)))
+		return np.diff(rows).max() if len(rows) > 1 else 0
+
+
+	def cluster_windows(self, data, clustering, window, params):
+
+		dict_data = dict((param, {}) for param in params)
+
+		if len(window) == 0:
+			return dict_data
+
+		rows = self.window_rows(data, window)
+		bounds = np.unique(np.concatenate(([0], rows, [len(data)])))
+
+		graph = clustering.neighbor_graph(data, bounds, max(param[0] for param in params))
+
+		for indx in range(1, len(window)):
+
+			start, end = rows[indx - 1], rows[indx]
+			data_window = data.iloc[start:end]
+
+			for param in params:
+
+				cluster_data = None
+				if clustering.is_large(len(data_window)):
+					cluster_data = clustering.clusterize_partitioned(data_window, ep=param[0], min_samples=param[1]).query('cluster != -1')
+				elif len(data_window) >= param[1]:
+					cluster_data = clustering.clusterize_graph(data_window, graph[start:end, start:end], ep=param[0], min_samples=param[1]).query('cluster != -1')
+
+				if self.summary:
+					dict_data[param][str(window[indx - 1])] = self.format_summary(cluster_data)
+				else:
+					dict_data[param][str(window[indx - 1])] = self.format_data(cluster_data)
 
 		return dict_data
 
 
-	def process(self, month_data, clustering, key):
+	def find_window(self, data, clustering, ep=0.01, sweep=None):
 
-		windows = {}
+		# One neighbor graph at the largest eps serves every (eps, min_samples) pair
+		params = sweep if sweep is not None else [(ep, 3)]
+
+		window = self.find_bounds(self.minute_histogram(data))
+		dict_data = self.cluster_windows(data, clustering, window, params)
+
+		if sweep is None:
+			return dict_data[params[0]]
+
+		return dict(('{0}:{1}'.format(*param), dict_data[param]) for param in params)
+
+
+	def split_types(self, month_data, key):
 
 		if 'crimes' in key:
+			crimes = month_data.groupby('type', observed=True).all().index
+			return [crime for crime in crimes if crime in self.crimes_chicago or crime in self.crimes_austin]
 
-			crimes = month_data.groupby('type').all().index
+		return ['unkown']
 
-			for crime in crimes:
-				if crime in self.crimes_chicago or crime in self.crimes_austin:
-					crimes_filtered = month_data.query("type == '%s'" % crime)
-					dict_data = self.find_window(crimes_filtered, clustering)
-					windows[crime] = dict_data
-		else:
-			dict_data = self.find_window(month_data, clustering, ep=0.02)
-			windows['unkown'] = dict_data
+
+	def type_data(self, month_data, key, crime):
+
+		if 'crimes' in key:
+			return month_data.query("type == '%s'" % crime)
+
+		return month_data
+
+
+	def type_ep(self, key):
+		return 0.01 if 'crimes' in key else 0.02
+
+
+	def process_type(self, month_data, clustering, key, crime, sweep=None):
+		return self.find_window(self.type_data(month_data, key, crime), clustering, ep=self.type_ep(key), sweep=sweep)
+
+
+	def process(self, month_data, clustering, key, sweep=None):
+
+		windows = {}
+
+		for crime in self.split_types(month_data, key):
+			windows[crime] = self.process_type(month_data, clustering, key, crime, sweep=sweep)
 
 		return windows
 
 
-	def write_output(self, output_data, day):
+	def has_large_window(self, month_data, clustering, key, crime, size):
+
+		if not clustering.is_large(size):
+			return False
+
+		return clustering.is_large(self.largest_window(self.type_data(month_data, key, crime)))
+
+
+	def process_parallel(self, frames, keys, clustering, sweep=None):
+
+		units = []
+		large = []
+
+		for indx_day in range(len(DAYS)):
+			for key in keys:
+				month_data = frames[(indx_day, key)]
+				sizes = month_data['type'].value_counts()
+
+				for crime in self.split_types(month_data, key):
+					size = sizes[crime] if 'crimes' in key else len(month_data)
+
+					if self.has_large_window(month_data, clustering, key, crime, size):
+						large.append((indx_day, key, crime))
+					else:
+						units.append((size, indx_day, key, crime))
+
+		# Largest units first so no worker is left with a big one at the end
+		units.sort(key=lambda unit: unit[0], reverse=True)
+
+		output_data = [dict((key.split('.')[0], {}) for key in keys) for day in DAYS]
+
+		# Workers can not start the tile pool, units with a large window are tiled from here
+		for indx_day, key, crime in large:
+			print('! Tile {0} {1} of {2}'.format(key, crime, DAYS[indx_day]))
+			output_data[indx_day][key.split('.')[0]][crime] = self.process_type(frames[(indx_day, key)], clustering, key, crime, sweep=sweep)
+
+		SHARED['frames'] = frames
+		pool = mp.Pool(clustering.jobs)
+
+		try:
+			tasks = [(self, indx_day, key, crime, sweep) for size, indx_day, key, crime in units]
 
-		if not os.path.exists('./data/mapped'):
-			os.makedirs('./data/mapped')
+			for indx_day, key, crime, windows in pool.imap_unordered(process_unit, tasks):
+				output_data[indx_day][key.split('.')[0]][crime] = windows
 
-		with open("./data/mapped/" + str(day) + '.json', "w") as write_file:
+		finally:
+			pool.close()
+			pool.join()
+			SHARED.clear()
+
+		return output_data
+
+
+	def write_output(self, output_data, day, folder='./data/mapped/', binary=False, stats=None):
+
+		if binary:
+			ContextMap(folder, summary=self.summary).write(output_data, day, stats)
+			return
+
+		if not os.path.exists(folder):
+			os.makedirs(folder)
+
+		with open(folder + str(day) + ('.summary' if self.summary else '') + '.json', "w") as write_file:
 			json.dump(output_data, write_file, indent=4)
 
 
-	def main(self):
+	def main(self, sweep=None, jobs=1, summary=False, incremental=False, bbox=False, margin=MARGIN):
 
 		print('!# Begin')
 
-		clustering = Clustering()
+		clustering = Clustering(jobs=jobs)
+		self.summary = summary
+
+		if bbox:
+			self.boxes = {}
+			self.margin = margin
+
+		# Sweep values come as 'eps:min_samples' strings
+		if sweep:
+			sweep = [(float(param.split(':')[0]), int(param.split(':')[1])) for param in sweep]
 
-		print('! Read all files')
-		dfs = self.read_data_folder()
+		store = IncidentStore()
+		partitions = store.partitions()
+
+		if partitions:
+			print('! Read from incident store')
+			dfs = None
+			keys = ['{1}_{0}'.format(city, context) for city, context in partitions]
+
+		else:
+			print('! Read all files')
+			dfs = self.read_data_folder()
+			keys = list(dfs.keys())
+
+		if incremental and (sweep or not partitions):
+			print('! Incremental mapping needs the incident store and no sweep')
+			incremental = False
+
+		if incremental and self.main_incremental(store, partitions, keys, clustering):
+			print('!# End')
+			return
 
 		print('! Process files')
 
-		for indx_day, day in enumerate(['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday']):
+		if jobs > 1:
+			self.main_parallel(store, partitions, dfs, keys, sweep, clustering)
+
+			if incremental:
+				self.save_state(store, partitions, keys)
+
+			print('!# End')
+			return
+
+		for indx_day, day in enumerate(DAYS):
 
 			print('! Day: {0}'.format(day))
 			output_data = {}
 
-			for key in dfs:
+			for indx_key, key in enumerate(keys):
 
 				print('! File: {0}'.format(key))
 
 				# key_output = {}
 
-				day_data = self.filter_daily(dfs[key], indx_day)
+				day_data = self.read_daily(store, partitions, dfs, indx_key, key, indx_day)
 
 				# for month in range(1, 13):
 
@@ -313,13 +663,221 @@ class ContextMapping:
 
 				# month_data = day_data['2018-' + str(month)]
 
-				windows = self.process(day_data, clustering, key)
+				windows = self.process(day_data, clustering, key, sweep=sweep)
 
 				# key_output[self.MONTHS[month]] = windows
 
 				output_data[key.split('.')[0]] = windows
 
-			self.write_output(output_data, day)
+			self.write_day(output_data, day, sweep)
+
+		if incremental:
+			self.save_state(store, partitions, keys)
 
 		print('!# End')
 
+
+	def read_daily(self, store, partitions, dfs, indx_key, key, indx_day):
+
+		if dfs is None:
+			return self.read_partition(store, partitions[indx_key][0], partitions[indx_key][1], indx_day)
+
+		return self.filter_daily(dfs[key], indx_day)
+
+
+	def write_day(self, output_data, day, sweep=None, stats=None):
+
+		if sweep:
+			self.write_output(output_data, day, folder='./data/mapped/sweep/')
+		else:
+			self.write_output(output_data, day, binary=True, stats=self.crop(output_data, stats if stats is not None else {}))
+
+
+	def main_parallel(self, store, partitions, dfs, keys, sweep, clustering):
+
+		frames = {}
+
+		for indx_day in range(len(DAYS)):
+			for indx_key, key in enumerate(keys):
+				frames[(indx_day, key)] = self.read_daily(store, partitions, dfs, indx_key, key, indx_day)
+
+		print('! Process {0} days with {1} processes'.format(len(DAYS), clustering.jobs))
+		output_data = self.process_parallel(frames, keys, clustering, sweep=sweep)
+
+		for indx_day, day in enumerate(DAYS):
+			self.write_day(output_data[indx_day], day, sweep)
+
+
+	def partition_name(self, city, context, dayofweek):
+		return '{0}/{1}/{2}'.format(city, context, dayofweek)
+
+
+	def read_state(self, name, folder='./data/mapped/state/'):
+
+		if not os.path.exists(folder + name + '.json'):
+			return None
+
+		with open(folder + name + '.json', 'r') as state_file:
+			return json.load(state_file)
+
+
+	def write_state(self, name, state, folder='./data/mapped/state/'):
+
+		if not os.path.exists(folder):
+			os.makedirs(folder)
+
+		with open(folder + name + '.json', 'w') as state_file:
+			json.dump(state, state_file)
+
+
+	def type_state(self, counts):
+		return {'counts': counts.tolist(), 'window': [int(bound) for bound in self.find_bounds(counts)]}
+
+
+	def save_state(self, store, partitions, keys):
+
+		print('! Save incremental state')
+
+		# Store rows already mapped, minute histograms and window bounds of every (day, type)
+		state = {'summary': self.summary, 'rows': {}, 'boxes': self.boxes_state(), 'ingested': store.ingested()}
+
+		for indx_day, day in enumerate(DAYS):
+
+			day_state = {}
+
+			for indx_key, key in enumerate(keys):
+
+				city, context = partitions[indx_key]
+				state['rows'][self.partition_name(city, context, indx_day)] = store.count(city, context, indx_day)
+
+				day_data = self.read_partition(store, city, context, indx_day)
+				day_state[key] = {}
+
+				for crime in self.split_types(day_data, key):
+					day_state[key][crime] = self.type_state(self.minute_histogram(self.type_data(day_data, key, crime)))
+
+			self.write_state(day, day_state)
+
+		self.write_state('rows', state)
+
+
+	def copy_windows(self, windows):
+
+		# Blocks are read from the map that is about to be rewritten
+		return dict((window, np.array(windows[window])) for window in windows.keys())
+
+
+	def process_new(self, day_data, new_data, clustering, key, key_state, previous, stats):
+
+		windows = {}
+		params = [(self.type_ep(key), 3)]
+
+		for crime in self.split_types(day_data, key):
+
+			data = self.type_data(day_data, key, crime)
+			new = self.type_data(new_data, key, crime)
+
+			old = key_state.get(crime)
+
+			if old is None or crime not in previous:
+				key_state[crime] = self.type_state(self.minute_histogram(data))
+				windows[crime] = self.cluster_windows(data, clustering, key_state[crime]['window'], params)[params[0]]
+				continue
+
+			key_state[crime] = self.type_state(np.asarray(old['counts']) + self.minute_histogram(new))
+			window = key_state[crime]['window']
+
+			# New bounds move every window, otherwise only the windows with new incidents change
+			if window != old['window']:
+				windows[crime] = self.cluster_windows(data, clustering, window, params)[params[0]]
+				continue
+
+			windows[crime] = self.copy_windows(previous[crime])
+
+			touched = np.unique(np.searchsorted(np.array(window) * 10, new['minute_of_day'].values, side='right') - 1)
+
+			for indx in touched[touched < len(window) - 1]:
+				data_window = self.get_window(window[indx], window[indx + 1], data)
+				windows[crime].update(self.cluster_windows(data_window, clustering, window[indx:indx + 2], params)[params[0]])
+
+			# Copied windows were cropped with the previous map, clustered ones are cropped when written
+			clustered = set(str(window[indx]) for indx in touched[touched < len(window) - 1])
+			for copied in windows[crime]:
+				if copied not in clustered:
+					stats[(key, crime, copied)] = previous[crime].stats(copied)
+
+		return windows
+
+
+	def main_incremental(self, store, partitions, keys, clustering):
+
+		state = self.read_state('rows')
+
+		# A state mapped with other boxes can not be updated
+		if self.boxes is not None:
+			for key in keys:
+				self.find_box(self.key_city(key))
+
+		if state is None or state['summary'] != self.summary or state.get('boxes') != self.boxes_state():
+			print('! No incremental state, map every incident')
+			return False
+
+		# Rows are only appended while the store keeps the files it had, in the same order
+		ingested = store.ingested()
+		if state.get('ingested') != ingested[:len(state.get('ingested') or [])]:
+			print('! Incident store was rebuilt, map every incident')
+			return False
+
+		state['ingested'] = ingested
+
+		print('! Map new incidents only')
+		context_map = ContextMap(summary=self.summary)
+
+		for indx_day, day in enumerate(DAYS):
+
+			print('! Day: {0}'.format(day))
+
+			previous = context_map.load(day) if context_map.exists(day) else {}
+			day_state = self.read_state(day) or {}
+
+			output_data = {}
+			stats = {}
+
+			for indx_key, key in enumerate(keys):
+
+				city, context = partitions[indx_key]
+				name = self.partition_name(city, context, indx_day)
+				done = state['rows'].get(name, 0)
+
+				if store.count(city, context, indx_day) == done and key in previous:
+					output_data[key] = dict((crime, self.copy_windows(previous[key][crime])) for crime in previous[key])
+					stats.update(((key, crime, window), previous[key][crime].stats(window)) for crime in previous[key] for window in previous[key][crime].keys())
+					continue
+
+				data = store.read(city, context, indx_day)
+				state['rows'][name] = len(data)
+
+				new_data = self.prepare_partition(data.iloc[done:].copy())
+				day_data = self.prepare_partition(data)
+
+				print('! File: {0}, {1} new incidents'.format(key, len(new_data)))
+
+				output_data[key] = self.process_new(day_data, new_data, clustering, key, day_state.setdefault(key, {}), previous.get(key, {}), stats)
+
+			self.write_day(output_data, day, stats=stats)
+			self.write_state(day, day_state)
+
+		self.write_state('rows', state)
+
+		return True
+
+
+def process_unit(task):
+
+	# Pool workers can not receive bound methods on python 2, units
+	# with a window above partition_size never get here
+	mapping, indx_day, key, crime, sweep = task
+	month_data = SHARED['frames'][(indx_day, key)]
+
+	return indx_day, key, crime, mapping.process_type(month_data, Clustering(), key, crime, sweep=sweep)
+
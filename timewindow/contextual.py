@@ -1,5 +1,7 @@
 import os
 import json
+import bisect
+import threading
 
 import pandas as pd
 import numpy as np
@@ -8,23 +10,246 @@ import matplotlib.pyplot as plt
 from scipy import stats
 from shapely.geometry import Point
 
+from .contextmap import ContextMap, WindowBlocks
+from .riskraster import RiskRaster
+from .binnedkde import BinnedKDE
+from .kernelcache import KernelCache, BUDGET
+
+
+# Densities computed at once by a ClusterMixture, components x points
+BLOCK = 1 << 20
+
+
+class ClusterMixture:
+
+	'''
+		Gaussian mixture with one component per cluster summary, it approximates the
+		gaussian_kde of the clustered points and pdf costs O(clusters) instead of O(points)
+	'''
+
+	def __init__(self, clusters, bandwidth=None, total=None):
+
+		counts = clusters[:, 0]
+		means = clusters[:, 1:3]
+
+		if bandwidth is None:
+			total = counts.sum()
+
+			# Covariance of all the points, as gaussian_kde computes it
+			spread = means - np.dot(counts, means) / total
+			cov_lat = np.dot(counts, clusters[:, 3] + spread[:, 0] * spread[:, 0])
+			cov_lat_lon = np.dot(counts, clusters[:, 4] + spread[:, 0] * spread[:, 1])
+			cov_lon = np.dot(counts, clusters[:, 5] + spread[:, 1] * spread[:, 1])
+
+			covariance = np.array([[cov_lat, cov_lat_lon], [cov_lat_lon, cov_lon]]) / (total - 1)
+
+			# Same failure as gaussian_kde on degenerate data
+			np.linalg.inv(covariance)
+
+			# Scott's factor, each point kernel is widened by the spread of its cluster
+			bandwidth = covariance * total ** (-2. / 6)
+
+		# Given a bandwidth and total the clusters are part of a larger window, weighted as in it
+		self.bandwidth = bandwidth
+		self.total = total
+
+		self.weights = counts / total
+		self.means = means
+		self.cov_lat = clusters[:, 3] + bandwidth[0, 0]
+		self.cov_lat_lon = clusters[:, 4] + bandwidth[0, 1]
+		self.cov_lon = clusters[:, 5] + bandwidth[1, 1]
+		self.det = self.cov_lat * self.cov_lon - self.cov_lat_lon ** 2
+
+
+	def pdf(self, points):
+
+		# Points as gaussian_kde takes them, (2, m) or a single [(lat, lon)]
+		points = np.atleast_2d(np.asarray(points, dtype=float))
+		if points.shape[0] != 2:
+			points = points.reshape(2, -1)
+
+		# Components x points densities, a block of points at a time
+		step = max(BLOCK // len(self.weights), 1)
+		return np.concatenate([self.density(points[:, start:start + step]) for start in range(0, points.shape[1], step)] or [np.zeros(0)])
+
+	__call__ = pdf
+
+
+	def density(self, points):
+
+		lat = points[0][None, :] - self.means[:, 0][:, None]
+		lon = points[1][None, :] - self.means[:, 1][:, None]
+
+		distance = (self.cov_lon[:, None] * lat * lat - 2 * self.cov_lat_lon[:, None] * lat * lon + self.cov_lat[:, None] * lon * lon) / self.det[:, None]
+		density = np.exp(-0.5 * distance) / (2 * np.pi * np.sqrt(self.det))[:, None]
+
+		return np.dot(self.weights, density)
+
+
+def point_mixture(points, bandwidth, total):
+
+	# gaussian_kde of points with the bandwidth and weight of a larger window, one component per point
+	clusters = np.column_stack((np.ones(len(points)), points[:, :2], np.zeros((len(points), 3))))
+	return ClusterMixture(clusters, bandwidth=bandwidth, total=total)
+
+
+def fit_kernel(points, summary=False, kde='gaussian', whole=None):
+
+	'''
+		Kernel, min, max and extent of the points of a window, None when it can not be
+		fitted. Given whole, the kernel_stats of the window the points were cropped from,
+		the kernel keeps its bandwidth and weights and is normalized by its min and max
+	'''
+
+	# Ref: https://stackoverflow.com/questions/31525393/how-to-plot-kernel-density-estimation-kde-and-zero-crossings-for-3d-data-in-py/31528905#31528905
+
+	if len(points) == 0:
+		return None
+
+	if summary:
+		xmin, xmax = points[:, 6].min(), points[:, 8].max()
+		ymin, ymax = points[:, 7].min(), points[:, 9].max()
+	else:
+		lats, lons = points[:, 0], points[:, 1]
+
+		xmin, xmax = lats.min(), lats.max()
+		ymin, ymax = lons.min(), lons.max()
+
+	if whole is not None:
+		total, bandwidth = whole[0], np.array([[whole[1], whole[2]], [whole[2], whole[3]]])
+
+		if summary:
+			kernel = ClusterMixture(points, bandwidth=bandwidth, total=total)
+		else:
+			kernel = BinnedKDE(np.vstack([lats, lons]), covariance=bandwidth, total=total) if kde == 'binned' else point_mixture(points, bandwidth, total)
+
+		# Binned kernels are normalized by the min and max of their own whole window surface
+		mini, maxi = (whole[6], whole[7]) if kde == 'binned' and not summary and len(whole) > 6 else (whole[4], whole[5])
+
+		return kernel, mini, maxi, (xmin, xmax, ymin, ymax)
+
+	X, Y = np.mgrid[xmin:xmax:100j, ymin:ymax:100j]
+	positions = np.vstack([X.ravel(), Y.ravel()])
+
+	try:
+		if summary:
+			kernel = ClusterMixture(points)
+		else:
+			kernel = BinnedKDE(np.vstack([lats, lons])) if kde == 'binned' else stats.gaussian_kde(np.vstack([lats, lons]))
+
+		Z = np.reshape(kernel(positions).T, X.shape)
+
+	except np.linalg.LinAlgError:
+		return None
+
+	return kernel, np.amin(Z), np.amax(Z), (xmin, xmax, ymin, ymax)
+
+
+def kernel_bandwidth(points, summary=False):
+
+	# Bandwidth kernel_stats would find, the kernel is built but never evaluated
+	if len(points) == 0:
+		return None
+
+	try:
+		return ClusterMixture(points).bandwidth if summary else stats.gaussian_kde(points[:, :2].T).covariance
+
+	except np.linalg.LinAlgError:
+		return None
+
+
+def kernel_stats(points, summary=False):
+
+	'''
+		(points, bandwidth lat lat, lat lon, lon lon, min, max) of the gaussian_kde of a
+		whole window, followed by the min and max of its BinnedKDE for points, what
+		fit_kernel needs to score the cropped points of the window the same way
+	'''
+
+	points = np.asarray(points, dtype=float)
+
+	fitted = fit_kernel(points, summary=summary)
+	if fitted is None:
+		return None
+
+	kernel, mini, maxi, _ = fitted
+	bandwidth, total = (kernel.bandwidth, kernel.total) if summary else (kernel.covariance, kernel.n)
+
+	stats = [float(total), float(bandwidth[0, 0]), float(bandwidth[0, 1]), float(bandwidth[1, 1]), float(mini), float(maxi)]
+
+	if not summary:
+		_, binned_mini, binned_maxi, _ = fit_kernel(points, kde='binned')
+		stats += [float(binned_mini), float(binned_maxi)]
+
+	return stats
+
 
 class Contextual:
 
 
 	def load_clusters(self, day):
-		with open("./data/mapped/" + str(day) + '.json', "r") as file:
+
+		# Binary maps are read lazily and only for this city
+		context_map = ContextMap(summary=self.summary)
+		if context_map.exists(day):
+			self.source = context_map.index_file(day)
+			return context_map.load(day, self.city)
+
+		self.source = "./data/mapped/" + str(day) + context_map.suffix + '.json'
+		with open(self.source, "r") as file:
 			return json.load(file)
 
 
-	def __init__(self, city='chicago', day='sunday'):
+	def load_raster(self):
+
+		raster = RiskRaster()
+		signature = raster.signature(self)
+
+		# The first process of a day and city builds the rasters, the others map them
+		if not raster.load(self.day, self.city, signature):
+			raster.build(self, signature)
+			raster.load(self.day, self.city, signature)
+
+		return raster
+
+
+	def __init__(self, city='chicago', day='sunday', summary=False, box=None, raster=False, kde='gaussian', cache_size=BUDGET):
 		
 		self.city = city
 		self.day = day
+
+		# Windows hold cluster summaries instead of points
+		self.summary = summary
+
+		# Scenario box the map was cropped to by cm --bbox
+		self.box = box
+
+		# 'gaussian' fits scipy's gaussian_kde, 'binned' the FFT approximation
+		self.kde = kde
 		
 		self.context_data = self.load_clusters(day)
+		self.valid_keys = sorted(str(x) for x in self.context_data if self.city in x)
+
+		# Fitted kernels by (context, type, window), bounded by cache_size megabytes
+		self.kernels = KernelCache(cache_size)
+
+		# Kernels only change where a window of some context starts
+		self.boundaries = self.window_starts(*self.valid_keys)
+		self.prefetcher = None
+		self.prefetched = None
+
+		# Cropping here would change the bandwidth and normalization of every window
+		if self.box is not None and not self.cropped():
+			print('! Map of {0} was not written with --bbox, contexts are fitted over the whole city'.format(city))
+
+		# Scores are read from precomputed surfaces instead of the kernels
+		self.raster = self.load_raster() if raster else None
+
+
+	def window_starts(self, *keys):
 
-		self.kernels = {}
+		# The last window of every type only changes at the start of some window
+		return sorted(set(int(window) for key in keys for types in self.context_data[key] for window in self.context_data[key][types].keys()))
 
 
 	def find_last_window(self, windows, step_time):
@@ -54,49 +279,79 @@ class Contextual:
 		plt.show()
 
 
-	def create_kde(self, contexts, key, last_window):
+	def window_stats(self, key, types, window):
 
-		# Ref: https://stackoverflow.com/questions/31525393/how-to-plot-kernel-density-estimation-kde-and-zero-crossings-for-3d-data-in-py/31528905#31528905
+		# Kernel statistics of the whole window, kept by maps cropped to a scenario box
+		blocks = self.context_data[key][types]
+		return blocks.stats(window) if isinstance(blocks, WindowBlocks) else None
 
-		if '{0}:{1}'.format(key, last_window) not in self.kernels:
 
-			lats, lons = [], []
+	def cropped(self):
+		return any(self.window_stats(key, types, window) is not None for key in self.valid_keys for types in self.context_data[key] for window in self.context_data[key][types].keys())
 
-			for c in contexts:
-				lats.append(c[0])
-				lons.append(c[1])
 
-			xmin, xmax = min(lats), max(lats)
-			ymin, ymax = min(lons), max(lons)
+	def fit_kde(self, contexts, whole=None):
 
-			X, Y = np.mgrid[xmin:xmax:100j, ymin:ymax:100j]
-			positions = np.vstack([X.ravel(), Y.ravel()])
-			values = np.vstack([lats, lons])
-			
-			try:
-				kernel = stats.gaussian_kde(values)
-				Z = np.reshape(kernel(positions).T, X.shape)
-				
-				self.kernels['{0}:{1}'.format(key, last_window)] = kernel
-				self.kernels['{0}:{1}:min'.format(key, last_window)] = np.amin(Z)
-				self.kernels['{0}:{1}:max'.format(key, last_window)] = np.amax(Z)
+		# Cropped maps were cut to the kernel reach at cm, with whole they score as the whole window
+		return fit_kernel(np.asarray(contexts, dtype=float), summary=self.summary, kde=self.kde, whole=whole)
 
-				#self.plot_kde(kernel ,lats, lons, Z, xmin, xmax, ymin, ymax)
 
-				return True
-			
-			except np.linalg.LinAlgError:
-				return False
+	def window_start(self, step_time):
+		return self.boundaries[max(bisect.bisect_right(self.boundaries, step_time) - 1, 0)] if self.boundaries else 0
+
+
+	def prepare_window(self, step_time):
+
+		for key in self.context_keys():
+			for types in self.context_data[key]:
+
+				last_window = self.find_last_window(list(self.context_data[key][types].keys()), step_time)
+				contexts = self.context_data[key][types][last_window]
 
-		return True
+				if len(contexts) > 0:
+					self.kernels.prefetch((key, types, last_window), lambda: self.fit_kde(contexts, self.window_stats(key, types, last_window)))
+
+
+	def prefetch(self, step_time):
+
+		'''
+			Fits the kernels of the windows active at step_time in a background thread,
+			the simulation keeps stepping SUMO meanwhile and scoring finds them cached
+		'''
+
+		if self.raster is not None or self.window_start(step_time) == self.prefetched:
+			return
+
+		self.join_prefetch()
+		self.prefetched = self.window_start(step_time)
+
+		self.prefetcher = threading.Thread(target=self.prepare_window, args=(step_time,))
+		self.prefetcher.daemon = True
+		self.prefetcher.start()
+
+
+	def join_prefetch(self):
 
+		if self.prefetcher is not None:
+			self.prefetcher.join()
+			self.prefetcher = None
 
-	def calculate_kde(self, contexts, point, key, last_window):
+
+	def create_kde(self, contexts, key, types, last_window):
+
+		# The cache is only used by one thread at a time
+		self.join_prefetch()
+
+		# Fitted kernel, min, max and extent of a window, None when it can not be fitted
+		return self.kernels.get((key, types, last_window), lambda: self.fit_kde(contexts, self.window_stats(key, types, last_window)))
+
+
+	def calculate_kde(self, fitted, point):
 		
 		try:
-			point_pdf = self.kernels['{0}:{1}'.format(key, last_window)].pdf([point])
+			point_pdf = fitted[0].pdf([point])
 
-			mini, maxi = self.kernels['{0}:{1}:min'.format(key, last_window)], self.kernels['{0}:{1}:max'.format(key, last_window)]
+			mini, maxi = fitted[1], fitted[2]
 
 			return float((point_pdf - mini) / (maxi - mini))
 
@@ -106,6 +361,9 @@ class Contextual:
 
 	def calculate_score(self, start, end, key, step_time):
 
+		if self.raster is not None:
+			return float(self.raster.lookup(key, step_time, [start[0], end[0]], [start[1], end[1]]).max())
+
 		score = [0]
 
 		# Without type
@@ -117,11 +375,11 @@ class Contextual:
 			contexts = self.context_data[key]['unknown'][last_window]
 
 			if len(contexts) > 0:
-				passed = self.create_kde(contexts, key, last_window)
+				fitted = self.create_kde(contexts, key, 'unknown', last_window)
 
-				if passed:
-					score.append(self.calculate_kde(contexts, (start[0], start[1]), key, last_window))
-					score.append(self.calculate_kde(contexts, (end[0], end[1]), key, last_window))
+				if fitted is not None:
+					score.append(self.calculate_kde(fitted, (start[0], start[1])))
+					score.append(self.calculate_kde(fitted, (end[0], end[1])))
 
 		# With type
 		else:
@@ -134,15 +392,97 @@ class Contextual:
 				contexts = self.context_data[key][types][last_window]
 
 				if len(contexts) > 0:
-					passed = self.create_kde(contexts, key, last_window)
+					fitted = self.create_kde(contexts, key, types, last_window)
 
-					if passed:
-						score.append(self.calculate_kde(contexts, (start[0], start[1]), key, last_window))
-						score.append(self.calculate_kde(contexts, (end[0], end[1]), key, last_window))
+					if fitted is not None:
+						score.append(self.calculate_kde(fitted, (start[0], start[1])))
+						score.append(self.calculate_kde(fitted, (end[0], end[1])))
 
 		return max(score)
 
 
+	def score_batch(self, starts, ends, key, step_time):
+
+		# Same score as calculate_score for every (start, end) pair at once
+		if self.raster is not None:
+			return np.maximum(self.raster.lookup(key, step_time, starts[:, 0], starts[:, 1]), self.raster.lookup(key, step_time, ends[:, 0], ends[:, 1]))
+
+		score = np.zeros(len(starts))
+		points = np.vstack([np.concatenate([starts[:, 0], ends[:, 0]]), np.concatenate([starts[:, 1], ends[:, 1]])])
+
+		for types in self.context_data[key]:
+
+			windows = list(self.context_data[key][types].keys())
+			last_window = self.find_last_window(windows, step_time)
+
+			contexts = self.context_data[key][types][last_window]
+
+			fitted = self.create_kde(contexts, key, types, last_window) if len(contexts) > 0 else None
+
+			if fitted is not None:
+
+				kernel, mini, maxi = fitted[0], fitted[1], fitted[2]
+
+				try:
+					values = (kernel.pdf(points) - mini) / (maxi - mini)
+				except np.linalg.LinAlgError:
+					continue
+
+				score = np.maximum(score, np.maximum(values[:len(starts)], values[len(starts):]))
+
+		return score
+
+
+	def context_keys(self):
+		return self.valid_keys
+
+
+	def context_scores(self, starts, ends, step_time, contexts=None):
+
+		# Scores of every context key, or only of the given contexts, as {context: array}
+		scores = {}
+
+		for key in self.context_keys():
+			if contexts is None or key.split('_')[0] in contexts:
+				scores[key.split('_')[0]] = self.score_batch(starts, ends, key, step_time)
+
+		return scores
+
+
+	def trade_off_batch(self, traffic, starts, ends, step_time, context_weight={'traffic': 1, 'crimes': 1, 'crashes': 1}):
+
+		'''
+			trade_off for arrays of roads, traffic (n,), starts and ends (n, 2).
+			Contexts weighted zero are not scored, their metrics are None
+		'''
+
+		starts, ends = np.asarray(starts, dtype=float).reshape(-1, 2), np.asarray(ends, dtype=float).reshape(-1, 2)
+
+		weighted = [key.split('_')[0] for key in self.context_keys() if context_weight[key.split('_')[0]] != 0]
+		scores = self.context_scores(starts, ends, step_time, contexts=weighted)
+
+		return self.combine_scores(traffic, scores, context_weight)
+
+
+	def combine_scores(self, traffic, scores, context_weight={'traffic': 1, 'crimes': 1, 'crashes': 1}):
+
+		# Weighted sum of trade_off from {context: array} scores, missing contexts add nothing
+		traffic = np.asarray(traffic, dtype=float)
+
+		overall_score = np.maximum(traffic * context_weight['traffic'], 0)
+
+		for context in scores:
+			overall_score += scores[context] * context_weight[context]
+
+		overall_score[overall_score <= 0] = 0.0001
+
+		metrics = {'traffic': traffic}
+		for key in self.context_keys():
+			metrics[key.split('_')[0]] = scores.get(key.split('_')[0])
+
+		return overall_score, metrics
+
+
 	def prepare_to_return(self, traffic, scores, valid_keys):
 
 		metrics = {}
@@ -0,0 +1,120 @@
+import os
+import json
+import bisect
+
+import numpy as np
+
+from .contextmap import ContextMap
+from .files import file_hash, written_aside
+
+
+class EdgeScores:
+
+	'''
+		Context scores of every edge of a net for every window of a day, one row per
+		start of a window and one column per edge at <day>.<city>.bin. Edges and
+		contexts are static within a window, so a simulation step only needs the
+		row its window starts at, found by bisection over the sorted timeline.
+	'''
+
+	def __init__(self, folder='./data/mapped/edges/'):
+		self.folder = folder
+
+		self.index = None
+		self.table = None
+		self.columns = None
+
+
+	def data_file(self, day, city):
+		return os.path.join(self.folder, '{0}.{1}.bin'.format(day, city))
+
+
+	def index_file(self, day, city):
+		return os.path.join(self.folder, '{0}.{1}.index.json'.format(day, city))
+
+
+	def signature(self, contextual, net):
+
+		# Binary maps keep their points next to the index
+		sources = [contextual.source]
+		context_map = ContextMap(summary=contextual.summary)
+		if contextual.source == context_map.index_file(contextual.day):
+			sources.append(context_map.data_file(contextual.day))
+
+		# Tables are rebuilt when the net, the map or the way it is scored changes
+		return {
+			'net': file_hash(net),
+			'source': file_hash(*sources),
+			'summary': contextual.summary,
+			'kde': contextual.kde,
+			'box': contextual.box.bounds() if contextual.box is not None else None,
+			'raster': contextual.raster.index['signature'] if contextual.raster is not None else None
+		}
+
+
+	def load(self, day, city, signature):
+
+		if not os.path.exists(self.index_file(day, city)):
+			return False
+
+		with open(self.index_file(day, city), 'r') as index_file:
+			index = json.load(index_file)
+
+		if index['signature'] != signature:
+			return False
+
+		self.index = index
+		self.columns = dict((edge, column) for column, edge in enumerate(index['edges']))
+
+		if index['rows'] > 0 and len(index['edges']) > 0:
+			self.table = np.memmap(self.data_file(day, city), dtype='float64', mode='r', shape=(index['rows'], len(index['edges'])))
+
+		return True
+
+
+	def build(self, contextual, signature, edges, starts, ends):
+
+		starts, ends = np.asarray(starts, dtype=float).reshape(-1, 2), np.asarray(ends, dtype=float).reshape(-1, 2)
+
+		rows = []
+		keys = {}
+
+		for key in contextual.context_keys():
+
+			bounds = contextual.window_starts(key)
+			keys[key] = {'bounds': bounds, 'rows': []}
+
+			for bound in bounds:
+				keys[key]['rows'].append(len(rows))
+				rows.append(contextual.score_batch(starts, ends, key, bound))
+
+		if not os.path.exists(self.folder):
+			os.makedirs(self.folder)
+
+		with written_aside(self.data_file(contextual.day, contextual.city), self.index_file(contextual.day, contextual.city)) as (data_file, index_file):
+
+			with open(data_file, 'wb') as table_file:
+				for row in rows:
+					np.asarray(row, dtype='float64').tofile(table_file)
+
+			with open(index_file, 'w') as table_index:
+				json.dump({'signature': signature, 'edges': list(edges), 'rows': len(rows), 'keys': keys}, table_index)
+
+
+	def lookup(self, key, step_time, edges):
+
+		columns = [self.columns[edge] for edge in edges]
+		key_index = self.index['keys'].get(key)
+
+		if key_index is None or self.table is None:
+			return np.zeros(len(columns))
+
+		row = key_index['rows'][max(bisect.bisect_right(key_index['bounds'], step_time) - 1, 0)]
+
+		return np.array(self.table[row][columns])
+
+
+	def context_scores(self, edges, step_time):
+
+		# Same {context: array} as Contextual.context_scores, for every context
+		return dict((key.split('_')[0], self.lookup(key, step_time, edges)) for key in sorted(self.index['keys']))
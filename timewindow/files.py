@@ -0,0 +1,32 @@
+import os
+import hashlib
+from contextlib import contextmanager
+
+
+def file_hash(*paths):
+
+	digest = hashlib.md5()
+
+	for path in paths:
+		with open(path, 'rb') as source:
+			for chunk in iter(lambda: source.read(1 << 20), b''):
+				digest.update(chunk)
+
+	return digest.hexdigest()
+
+
+@contextmanager
+def written_aside(*paths):
+
+	'''
+		Temporary paths to write the files at paths to, renamed over them once
+		every one is written, so other processes never see half a file
+	'''
+
+	# The extension is kept last, np.savez appends .npz to any other name
+	temporaries = ['{0}.{1}.tmp{2}'.format(root, os.getpid(), extension) for root, extension in map(os.path.splitext, paths)]
+
+	yield temporaries
+
+	for temporary, path in zip(temporaries, paths):
+		os.rename(temporary, path)
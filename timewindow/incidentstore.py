@@ -0,0 +1,184 @@
+import os
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+# Typed columns kept for every partition
+COLUMNS = {
+			'timestamp': 'datetime64[ns]',
+			'minute': 'int16',
+			'lat': 'float64',
+			'lon': 'float64',
+			'type': 'int16'
+}
+
+
+class IncidentStore:
+
+	'''
+		Columnar incidents partitioned as <city>/<context>/<dayofweek>/<column>.bin,
+		the type column holds codes for the categories listed at <city>/<context>/meta.json
+	'''
+
+	def __init__(self, folder='./data/store/'):
+		self.folder = folder
+		self.categories = {}
+
+
+	def split_name(self, file):
+
+		# chicago_crimes_2018.csv -> ('chicago', 'crimes')
+		parts = file.split('.')[0].split('_')
+		return parts[0], parts[1]
+
+
+	def partition_folder(self, city, context, dayofweek):
+		return os.path.join(self.folder, city, context, str(dayofweek))
+
+
+	def meta_file(self, city, context):
+		return os.path.join(self.folder, city, context, 'meta.json')
+
+
+	def clear(self):
+
+		if os.path.exists(self.folder):
+			shutil.rmtree(self.folder)
+
+		self.categories = {}
+
+
+	def ingested(self):
+
+		path = os.path.join(self.folder, 'ingested.json')
+
+		if not os.path.exists(path):
+			return []
+
+		with open(path, 'r') as file:
+			return json.load(file)
+
+
+	def mark_ingested(self, file):
+
+		files = self.ingested()
+		if file in files:
+			return
+
+		if not os.path.exists(self.folder):
+			os.makedirs(self.folder)
+
+		with open(os.path.join(self.folder, 'ingested.json'), 'w') as ingested_file:
+			json.dump(files + [file], ingested_file, indent=4)
+
+
+	def partitions(self):
+
+		partitions = []
+
+		if not os.path.exists(self.folder):
+			return partitions
+
+		for city in sorted(os.listdir(self.folder)):
+			if not os.path.isdir(os.path.join(self.folder, city)):
+				continue
+
+			for context in sorted(os.listdir(os.path.join(self.folder, city))):
+				if os.path.exists(self.meta_file(city, context)):
+					partitions.append((city, context))
+
+		return partitions
+
+
+	def load_categories(self, city, context):
+
+		if (city, context) not in self.categories:
+			if os.path.exists(self.meta_file(city, context)):
+				with open(self.meta_file(city, context), 'r') as file:
+					self.categories[(city, context)] = json.load(file)['types']
+			else:
+				self.categories[(city, context)] = []
+
+		return self.categories[(city, context)]
+
+
+	def encode_types(self, city, context, types):
+
+		categories = self.load_categories(city, context)
+
+		for category in pd.unique(types):
+			if category not in categories:
+				categories.append(category)
+
+		return pd.Categorical(types, categories=categories).codes.astype(COLUMNS['type'])
+
+
+	def append(self, file, data, date_format=None):
+
+		city, context = self.split_name(file)
+
+		timestamps = pd.to_datetime(data['Date'], format=date_format, infer_datetime_format=date_format is None)
+
+		columns = {
+			'timestamp': timestamps.values,
+			'minute': (timestamps.dt.hour * 60 + timestamps.dt.minute).values.astype(COLUMNS['minute']),
+			'lat': data['Latitude'].values.astype(COLUMNS['lat']),
+			'lon': data['Longitude'].values.astype(COLUMNS['lon']),
+			'type': self.encode_types(city, context, data['Type'].values)
+		}
+
+		daysofweek = timestamps.dt.dayofweek.values
+
+		for dayofweek in np.unique(daysofweek):
+
+			folder = self.partition_folder(city, context, dayofweek)
+			if not os.path.exists(folder):
+				os.makedirs(folder)
+
+			rows = daysofweek == dayofweek
+
+			for column in COLUMNS:
+				with open(os.path.join(folder, column + '.bin'), 'ab') as file:
+					columns[column][rows].tofile(file)
+
+		with open(self.meta_file(city, context), 'w') as file:
+			json.dump({'columns': COLUMNS, 'types': self.load_categories(city, context)}, file, indent=4)
+
+
+	def count(self, city, context, dayofweek):
+
+		path = os.path.join(self.partition_folder(city, context, dayofweek), 'minute.bin')
+
+		if not os.path.exists(path):
+			return 0
+
+		return os.path.getsize(path) // np.dtype(COLUMNS['minute']).itemsize
+
+
+	def read(self, city, context, dayofweek):
+
+		folder = self.partition_folder(city, context, dayofweek)
+
+		columns = {}
+		for column in COLUMNS:
+			path = os.path.join(folder, column + '.bin')
+			if os.path.exists(path):
+				columns[column] = np.fromfile(path, dtype=COLUMNS[column])
+			else:
+				columns[column] = np.empty(0, dtype=COLUMNS[column])
+
+		types = pd.Categorical.from_codes(columns['type'], categories=self.load_categories(city, context))
+
+		df = pd.DataFrame({
+			'lat': columns['lat'],
+			'lon': columns['lon'],
+			'type': types,
+		}, index=pd.DatetimeIndex(columns['timestamp'], name='datetime'))
+
+		df['minute_of_day'] = columns['minute']
+		df['dayofweek'] = np.int8(dayofweek)
+
+		return df
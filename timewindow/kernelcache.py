@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Default memory budget of the fitted kernels, in megabytes
+BUDGET = 512
+
+
+def kernel_size(kernel):
+
+	# Bytes of the arrays a kernel keeps, its points, grid or cluster components
+	return sum(value.nbytes for value in vars(kernel).values() if isinstance(value, np.ndarray))
+
+
+class KernelCache:
+
+	'''
+		Fitted kernels of a Contextual keyed by (context, type, window), the least
+		recently used are evicted once their arrays exceed the memory budget.
+		Failed fits are kept as None so they are not fitted again.
+	'''
+
+	def __init__(self, budget=BUDGET):
+		self.budget = int(budget * 1024 * 1024)
+
+		self.entries = OrderedDict()
+		self.sizes = {}
+		self.size = 0
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.prefetches = 0
+		self.fit_time = 0.0
+
+
+	def get(self, cache_key, fit):
+
+		if cache_key in self.entries:
+			self.hits += 1
+
+			fitted = self.entries.pop(cache_key)
+			self.entries[cache_key] = fitted
+
+			return fitted
+
+		self.misses += 1
+
+		begin = time.time()
+		fitted = fit()
+		self.fit_time += time.time() - begin
+
+		self.put(cache_key, fitted)
+
+		return fitted
+
+
+	def prefetch(self, cache_key, fit):
+
+		# Fitted ahead of use, neither a hit nor a miss
+		if cache_key in self.entries:
+			return
+
+		self.prefetches += 1
+
+		begin = time.time()
+		fitted = fit()
+		self.fit_time += time.time() - begin
+
+		self.put(cache_key, fitted)
+
+
+	def put(self, cache_key, fitted):
+
+		self.entries[cache_key] = fitted
+		self.sizes[cache_key] = kernel_size(fitted[0]) if fitted is not None else 0
+		self.size += self.sizes[cache_key]
+
+		# The newest entry stays even when it is larger than the budget alone
+		while self.size > self.budget and len(self.entries) > 1:
+			oldest, _ = self.entries.popitem(last=False)
+			self.size -= self.sizes.pop(oldest)
+			self.evictions += 1
+
+
+	def stats(self):
+
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'prefetches': self.prefetches,
+			'fit_time': self.fit_time,
+			'entries': len(self.entries),
+			'size': self.size,
+			'budget': self.budget
+		}
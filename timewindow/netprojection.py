@@ -0,0 +1,152 @@
+import xml.etree.cElementTree as ET
+
+import numpy as np
+
+
+# WGS84 ellipsoid and UTM constants
+AXIS = 6378137.0
+FLATTENING = 1 / 298.257223563
+SCALE = 0.9996
+FALSE_EASTING = 500000.0
+FALSE_NORTHING = 10000000.0
+
+
+class UTMProjection:
+
+	'''
+		Inverse of the UTM projection SUMO applies to nets converted from OSM, the same
+		as traci.simulation.convertGeo. Uses Krueger's series to the third order of
+		the third flattening, millimetre accurate within a zone, on whole arrays.
+	'''
+
+	def __init__(self, zone, south=False, offset=(0.0, 0.0)):
+		self.zone = zone
+		self.south = south
+		self.offset = offset
+
+		n = FLATTENING / (2 - FLATTENING)
+
+		self.radius = AXIS / (1 + n) * (1 + n ** 2 / 4 + n ** 4 / 64)
+		self.beta = [n / 2 - 2 * n ** 2 / 3 + 37 * n ** 3 / 96, n ** 2 / 48 + n ** 3 / 15, 17 * n ** 3 / 480]
+		self.delta = [2 * n - 2 * n ** 2 / 3 - 2 * n ** 3, 7 * n ** 2 / 3 - 8 * n ** 3 / 5, 56 * n ** 3 / 15]
+
+
+	def to_geo(self, x, y):
+
+		# Net coordinates to (lon, lat) in degrees, as convertGeo returns them
+		easting = np.asarray(x, dtype=float) - self.offset[0]
+		northing = np.asarray(y, dtype=float) - self.offset[1]
+
+		if self.south:
+			northing = northing - FALSE_NORTHING
+
+		xi = northing / (SCALE * self.radius)
+		eta = (easting - FALSE_EASTING) / (SCALE * self.radius)
+
+		xi_prime, eta_prime = xi.copy(), eta.copy()
+		for j, beta in enumerate(self.beta, 1):
+			xi_prime -= beta * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+			eta_prime -= beta * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+
+		chi = np.arcsin(np.sin(xi_prime) / np.cosh(eta_prime))
+
+		lat = chi.copy()
+		for j, delta in enumerate(self.delta, 1):
+			lat += delta * np.sin(2 * j * chi)
+
+		lon = np.radians(6 * self.zone - 183) + np.arctan2(np.sinh(eta_prime), np.cos(xi_prime))
+
+		return np.degrees(lon), np.degrees(lat)
+
+
+def read_projection(net):
+
+	'''
+		UTMProjection of the <location> element of a net, None when the net is not
+		projected or uses a projection other than WGS84 UTM
+	'''
+
+	for _, element in ET.iterparse(net, events=('start',)):
+		if element.tag == 'location':
+			parameters = {}
+			for token in element.get('projParameter', '!').split():
+				name, _, value = token.lstrip('+').partition('=')
+				parameters[name] = value
+
+			if parameters.get('proj') != 'utm' or parameters.get('ellps', 'WGS84') != 'WGS84' or 'zone' not in parameters:
+				return None
+
+			offset = tuple(map(float, element.get('netOffset', '0,0').split(',')))
+			return UTMProjection(int(parameters['zone']), south='south' in parameters, offset=offset)
+
+		if element.tag in ('edge', 'junction'):
+			break
+
+	return None
+
+
+def read_lanes(net, lane='0'):
+
+	# Shape, speed and length of the given lane of every normal edge and its lane count, shapes in net coordinates
+	lanes = {}
+
+	for _, element in ET.iterparse(net, events=('end',)):
+		if element.tag == 'edge':
+			if element.get('function') != 'internal':
+				lane_tags = element.findall('lane')
+
+				for lane_tag in lane_tags:
+					if lane_tag.get('id') == '{0}_{1}'.format(element.get('id'), lane):
+						lanes[element.get('id')] = {
+							'shape': [tuple(map(float, point.split(',')[:2])) for point in lane_tag.get('shape').split()],
+							'speed': float(lane_tag.get('speed')),
+							'length': float(lane_tag.get('length')),
+							'lanes': len(lane_tags)
+						}
+
+			element.clear()
+
+	return lanes
+
+
+def read_shapes(net, lane='0'):
+	return dict((edge, attributes['shape']) for edge, attributes in read_lanes(net, lane).items())
+
+
+def geo_shapes(net, lane='0'):
+
+	'''
+		Shapes of every edge as (lat, lon) arrays, all the points of the net are
+		projected at once. None when the net can not be projected offline
+	'''
+
+	projection = read_projection(net)
+	if projection is None:
+		return None
+
+	shapes = read_shapes(net, lane)
+	edges = sorted(shapes)
+
+	points = np.array([point for edge in edges for point in shapes[edge]], dtype=float).reshape(-1, 2)
+	lons, lats = projection.to_geo(points[:, 0], points[:, 1])
+
+	geo = {}
+	offset = 0
+	for edge in edges:
+		geo[edge] = np.column_stack([lats[offset:offset + len(shapes[edge])], lons[offset:offset + len(shapes[edge])]])
+		offset += len(shapes[edge])
+
+	return geo
+
+
+def edge_coords(net, edges):
+
+	# (lat, lon) of the first two points of lane 0, the start and end traffic_mannager.read_coords asks SUMO for
+	geo = geo_shapes(net)
+	if geo is None:
+		return None
+
+	starts = [tuple(geo[edge][0]) for edge in edges]
+	ends = [tuple(geo[edge][1]) for edge in edges]
+
+	return starts, ends
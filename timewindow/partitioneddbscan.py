@@ -0,0 +1,192 @@
+import multiprocessing as mp
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from sklearn.neighbors import NearestNeighbors
+
+
+# Points inherited by the forked workers
+SHARED = {}
+
+
+class PartitionedDBSCAN:
+
+	'''
+		DBSCAN over grid tiles clustered in parallel, each tile reads a halo of
+		2 * eps around it so core points and their edges are exact. Tiles are
+		merged with the same labels as sklearn's DBSCAN.
+	'''
+
+	def __init__(self, eps=0.01, min_samples=3, tile=None, jobs=1):
+		self.eps = eps
+		self.min_samples = min_samples
+		self.tile = tile
+		self.jobs = jobs
+
+		# Slack so float rounding at the tile border never drops a neighbor
+		self.margin = eps * (1 + 1e-6)
+
+
+	def tile_size(self, points):
+
+		if self.tile is not None:
+			return max(self.tile, 2.0001 * self.margin)
+
+		# Around four tiles per process along the largest side
+		extent = np.max(np.ptp(points, axis=0))
+		per_axis = np.ceil(np.sqrt(4 * self.jobs))
+
+		return max(extent / per_axis, 2.0001 * self.margin)
+
+
+	def make_tasks(self, points):
+
+		size = self.tile_size(points)
+		origin = points.min(axis=0)
+
+		cells = np.floor((points - origin) / size).astype(np.int64)
+		shape = cells.max(axis=0) + 1
+
+		cell_ids = cells[:, 0] * shape[1] + cells[:, 1]
+		order = np.argsort(cell_ids, kind='mergesort')
+		bounds = np.searchsorted(cell_ids[order], np.arange(shape[0] * shape[1] + 1))
+
+		tasks = []
+
+		for cell_id in np.unique(cell_ids):
+			x, y = cell_id // shape[1], cell_id % shape[1]
+
+			lower = origin + np.array([x, y]) * size
+			upper = lower + size
+
+			# The tile and its eight neighbors hold every point of the halo
+			outer = []
+			for nx in range(max(x - 1, 0), min(x + 2, shape[0])):
+				for ny in range(max(y - 1, 0), min(y + 2, shape[1])):
+					neighbor = nx * shape[1] + ny
+					outer.append(order[bounds[neighbor]:bounds[neighbor + 1]])
+
+			outer = np.sort(np.concatenate(outer))
+			inside = np.all((points[outer] >= lower - 2 * self.margin) & (points[outer] <= upper + 2 * self.margin), axis=1)
+
+			owned = np.sort(order[bounds[cell_id]:bounds[cell_id + 1]])
+
+			tasks.append((owned, outer[inside], lower, upper))
+
+		return tasks
+
+
+	def cluster_tile(self, points, owned, outer, lower, upper):
+
+		outer_points = points[outer]
+
+		# Points whose whole eps neighborhood is inside outer
+		inner = np.flatnonzero(np.all((outer_points >= lower - self.margin) & (outer_points <= upper + self.margin), axis=1))
+		owned = np.searchsorted(outer, owned)
+
+		tree = NearestNeighbors(radius=self.eps, algorithm='ball_tree').fit(outer_points)
+		graph = tree.radius_neighbors_graph(outer_points[inner], mode='connectivity')
+
+		# Same rule as sklearn, the point itself counts for min_samples
+		core = np.zeros(len(outer), dtype=bool)
+		core[inner] = graph.getnnz(axis=1) >= self.min_samples
+
+		owned_graph = graph[np.searchsorted(inner, owned)]
+		owned_core = core[owned]
+
+		# Edges from owned core points to every core neighbor
+		edges = owned_graph[owned_core].tocoo()
+		keep = core[edges.col]
+		start, end = owned[owned_core][edges.row[keep]], edges.col[keep]
+
+		local = sparse.coo_matrix((np.ones(len(start)), (start, end)), shape=(len(outer), len(outer)))
+		_, components = connected_components(local, directed=False)
+
+		# Each local component becomes a star around its smallest node
+		nodes = np.unique(np.concatenate([owned[owned_core], end]))
+		center = np.full(len(outer), len(outer), dtype=np.int64)
+		np.minimum.at(center, components[nodes], nodes)
+
+		# Border points keep one core neighbor per local component
+		edges = owned_graph[~owned_core].tocoo()
+		keep = core[edges.col]
+		border, neighbor = owned[~owned_core][edges.row[keep]], edges.col[keep]
+
+		_, unique = np.unique(border * len(outer) + components[neighbor], return_index=True)
+
+		return (outer[owned], owned_core, outer[nodes], outer[center[components[nodes]]],
+				outer[border[unique]], outer[neighbor[unique]])
+
+
+	def merge(self, total, results):
+
+		is_core = np.zeros(total, dtype=bool)
+		star_start, star_end, border, neighbor = [], [], [], []
+
+		for result in results:
+			is_core[result[0]] = result[1]
+			star_start.append(result[2])
+			star_end.append(result[3])
+			border.append(result[4])
+			neighbor.append(result[5])
+
+		star_start, star_end = np.concatenate(star_start), np.concatenate(star_end)
+		border, neighbor = np.concatenate(border), np.concatenate(neighbor)
+
+		graph = sparse.coo_matrix((np.ones(len(star_start)), (star_start, star_end)), shape=(total, total))
+		count, components = connected_components(graph, directed=False)
+
+		# sklearn numbers the clusters by their smallest core point
+		cores = np.flatnonzero(is_core)
+		first = np.full(count, total, dtype=np.int64)
+		np.minimum.at(first, components[cores], cores)
+
+		found = np.flatnonzero(first < total)
+		number = np.full(count, -1, dtype=np.int64)
+		number[found[np.argsort(first[found])]] = np.arange(len(found))
+
+		labels = np.full(total, -1, dtype=np.int64)
+		labels[cores] = number[components[cores]]
+
+		# A border point joins the first cluster that reaches it
+		best = np.full(total, total, dtype=np.int64)
+		np.minimum.at(best, border, number[components[neighbor]])
+
+		reached = best < total
+		labels[reached] = best[reached]
+
+		return labels
+
+
+	def fit_predict(self, points):
+
+		points = np.asarray(points, dtype=float)
+
+		if len(points) == 0:
+			return np.empty(0, dtype=np.int64)
+
+		tasks = self.make_tasks(points)
+
+		if self.jobs <= 1 or len(tasks) == 1:
+			results = [self.cluster_tile(points, *task) for task in tasks]
+
+		else:
+			SHARED['points'] = points
+			pool = mp.Pool(self.jobs)
+
+			try:
+				results = pool.map(cluster_tile, [(self,) + task for task in tasks])
+			finally:
+				pool.close()
+				pool.join()
+				SHARED.clear()
+
+		return self.merge(len(points), results)
+
+
+def cluster_tile(task):
+
+	# Pool workers can not receive bound methods on python 2
+	engine, owned, outer, lower, upper = task
+	return engine.cluster_tile(SHARED['points'], owned, outer, lower, upper)
@@ -0,0 +1,197 @@
+import os
+import json
+import bisect
+
+import numpy as np
+
+from .files import written_aside
+
+
+# Nodes along each side of a raster
+SIZE = 128
+
+# Fraction of the contexts extent added on each side, kernels fade within a few bandwidths
+PADDING = 0.25
+
+# Smallest padding in degrees, for windows with a single place
+MIN_PADDING = 0.001
+
+
+class RiskRaster:
+
+	'''
+		Normalized KDE surfaces of a day and city sampled on one grid per context key,
+		stacked at <day>.<city>.bin and memory-mapped so every simulation process shares them.
+		Besides one surface per (context, type, window) each key keeps the max over its
+		types for every combination of last windows, the score calculate_score returns.
+	'''
+
+	def __init__(self, folder='./data/mapped/raster/', size=SIZE):
+		self.folder = folder
+		self.size = size
+
+		self.index = None
+		self.stack = None
+
+
+	def data_file(self, day, city):
+		return os.path.join(self.folder, '{0}.{1}.bin'.format(day, city))
+
+
+	def index_file(self, day, city):
+		return os.path.join(self.folder, '{0}.{1}.index.json'.format(day, city))
+
+
+	def signature(self, contextual):
+
+		# Rasters are rebuilt when the map or the way it is scored changes
+		return {
+			'size': self.size,
+			'summary': contextual.summary,
+			'kde': contextual.kde,
+			'box': contextual.box.bounds() if contextual.box is not None else None,
+			'source': os.path.getmtime(contextual.source)
+		}
+
+
+	def load(self, day, city, signature):
+
+		if not os.path.exists(self.index_file(day, city)):
+			return False
+
+		with open(self.index_file(day, city), 'r') as index_file:
+			index = json.load(index_file)
+
+		if index['signature'] != signature:
+			return False
+
+		self.index = index
+
+		if index['surfaces'] > 0:
+			self.stack = np.memmap(self.data_file(day, city), dtype='float32', mode='r', shape=(index['surfaces'], self.size, self.size))
+
+		return True
+
+
+	def key_extent(self, fitted):
+
+		extents = np.array([kde[3] for kde in fitted.values()])
+
+		xmin, xmax = extents[:, 0].min(), extents[:, 1].max()
+		ymin, ymax = extents[:, 2].min(), extents[:, 3].max()
+
+		xpad = max((xmax - xmin) * PADDING, MIN_PADDING)
+		ypad = max((ymax - ymin) * PADDING, MIN_PADDING)
+
+		return [xmin - xpad, xmax + xpad, ymin - ypad, ymax + ypad]
+
+
+	def build_key(self, contextual, key, surfaces):
+
+		context_data = contextual.context_data[key]
+
+		fitted = {}
+		for crime in context_data:
+			for window in context_data[crime].keys():
+				contexts = context_data[crime][window]
+
+				if len(contexts) > 0:
+					kde = contextual.fit_kde(contexts, contextual.window_stats(key, crime, window))
+					if kde is not None:
+						fitted[(crime, window)] = kde
+
+		if not fitted:
+			return None
+
+		extent = self.key_extent(fitted)
+
+		X, Y = np.meshgrid(np.linspace(extent[0], extent[1], self.size), np.linspace(extent[2], extent[3], self.size), indexing='ij')
+		nodes = np.vstack([X.ravel(), Y.ravel()])
+
+		key_index = {'extent': extent, 'types': {}, 'bounds': [], 'max': []}
+		slots = {}
+
+		for crime, window in sorted(fitted):
+			kernel, mini, maxi, _ = fitted[(crime, window)]
+
+			slots[(crime, window)] = len(surfaces)
+			key_index['types'].setdefault(crime, {})[window] = len(surfaces)
+
+			surfaces.append(((kernel(nodes) - mini) / (maxi - mini)).reshape(self.size, self.size).astype('float32'))
+
+		for bound in contextual.window_starts(key):
+
+			# calculate_score starts from a zero score
+			surface = np.zeros((self.size, self.size), dtype='float32')
+
+			for crime in context_data:
+				last_window = contextual.find_last_window(list(context_data[crime].keys()), bound)
+				if (crime, last_window) in slots:
+					surface = np.maximum(surface, surfaces[slots[(crime, last_window)]])
+
+			key_index['bounds'].append(bound)
+			key_index['max'].append(len(surfaces))
+			surfaces.append(surface)
+
+		return key_index
+
+
+	def build(self, contextual, signature):
+
+		surfaces = []
+		keys = {}
+
+		for key in sorted(contextual.context_data):
+			if contextual.city in key:
+				keys[key] = self.build_key(contextual, key, surfaces)
+
+		if not os.path.exists(self.folder):
+			os.makedirs(self.folder)
+
+		with written_aside(self.data_file(contextual.day, contextual.city), self.index_file(contextual.day, contextual.city)) as (data_file, index_file):
+
+			with open(data_file, 'wb') as stack_file:
+				for surface in surfaces:
+					surface.tofile(stack_file)
+
+			with open(index_file, 'w') as stack_index:
+				json.dump({'signature': signature, 'size': self.size, 'surfaces': len(surfaces), 'keys': keys}, stack_index)
+
+
+	def interpolate(self, surface, extent, lats, lons):
+
+		# Away from the contexts the score is the zero calculate_score starts from
+		return bilinear(surface, extent, lats, lons)
+
+
+	def lookup(self, key, step_time, lats, lons):
+
+		lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+		key_index = self.index['keys'].get(key)
+
+		if key_index is None:
+			return np.zeros(lats.shape)
+
+		slot = key_index['max'][max(bisect.bisect_right(key_index['bounds'], step_time) - 1, 0)]
+
+		return self.interpolate(self.stack[slot], key_index['extent'], lats, lons)
+
+
+def bilinear(surface, extent, lats, lons, outside=0.0):
+
+	xmin, xmax, ymin, ymax = extent
+	rows, columns = surface.shape
+
+	x = (lats - xmin) / (xmax - xmin) * (rows - 1)
+	y = (lons - ymin) / (ymax - ymin) * (columns - 1)
+
+	inside = (x >= 0) & (x <= rows - 1) & (y >= 0) & (y <= columns - 1)
+
+	x0 = np.clip(np.floor(x), 0, rows - 2).astype(np.int64)
+	y0 = np.clip(np.floor(y), 0, columns - 2).astype(np.int64)
+	dx, dy = x - x0, y - y0
+
+	values = (surface[x0, y0] * (1 - dx) * (1 - dy) + surface[x0 + 1, y0] * dx * (1 - dy) +
+			surface[x0, y0 + 1] * (1 - dx) * dy + surface[x0 + 1, y0 + 1] * dx * dy)
+
+	return np.where(inside, values, outside)
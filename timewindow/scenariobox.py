@@ -0,0 +1,91 @@
+import os
+import xml.etree.cElementTree as ET
+
+import numpy as np
+
+
+# Simulated areas as [(top, left), (bottom, right)], same boxes as TrafficMiner.SCENARIO
+SCENARIOS = {'chicago': [(41.8872, -87.6517), (41.8663, -87.6246)]}
+
+# Degrees kept around the box so kernels and clusters at its border still see their neighbors
+MARGIN = 0.05
+
+# Kernel standard deviations kept around the box, farther points change scores inside by less than exp(-REACH ** 2 / 2)
+REACH = 4.
+
+
+class ScenarioBox:
+
+	'''
+		Bounding box of a simulated scenario grown by a kernel margin, incidents
+		outside of it do not change the scores of the roads inside
+	'''
+
+	def __init__(self, top, left, bottom, right, margin=MARGIN):
+		self.top = top + margin
+		self.left = left - margin
+		self.bottom = bottom - margin
+		self.right = right + margin
+
+		self.margin = margin
+
+
+	def reach(self, bandwidth):
+
+		# The same box with at least REACH kernel standard deviations of margin
+		margin = max(self.margin, REACH * np.sqrt(bandwidth))
+		return ScenarioBox(self.top - self.margin, self.left + self.margin, self.bottom + self.margin, self.right - self.margin, margin=margin)
+
+
+	def bounds(self):
+		return [self.top, self.left, self.bottom, self.right]
+
+
+	def mask(self, lats, lons):
+		return (lats >= self.bottom) & (lats <= self.top) & (lons >= self.left) & (lons <= self.right)
+
+
+	def crop_points(self, points):
+		return points[self.mask(points[:, 0], points[:, 1])]
+
+
+	def crop_summary(self, clusters):
+
+		# Clusters are kept while their bounds touch the box
+		keep = (clusters[:, 8] >= self.bottom) & (clusters[:, 6] <= self.top) & (clusters[:, 9] >= self.left) & (clusters[:, 7] <= self.right)
+		return clusters[keep]
+
+
+def read_net_box(net, margin=MARGIN):
+
+	# origBoundary of a net converted from OSM is 'lon_min,lat_min,lon_max,lat_max'
+	for _, element in ET.iterparse(net, events=('start',)):
+		if element.tag == 'location':
+			boundary = element.get('origBoundary')
+			if boundary is None or element.get('projParameter', '!') == '!':
+				return None
+
+			left, bottom, right, top = map(float, boundary.split(','))
+			return ScenarioBox(top, left, bottom, right, margin=margin)
+
+		if element.tag in ('edge', 'junction'):
+			break
+
+	return None
+
+
+def find_box(city, net=None, margin=MARGIN):
+
+	# The extent of the SUMO net when available, otherwise the configured scenario
+	net = net or './scenario/{0}.net.xml'.format(city)
+
+	if os.path.exists(net):
+		box = read_net_box(net, margin=margin)
+		if box is not None:
+			return box
+
+	if city in SCENARIOS:
+		(top, left), (bottom, right) = SCENARIOS[city]
+		return ScenarioBox(top, left, bottom, right, margin=margin)
+
+	return None
@@ -59,12 +59,12 @@ class Ring:
 		if args.cd: 
 			print('!### Task: cd')
 			call = TASKS['cd']
-			call.main()
+			call.main(jobs=args.jobs[0], incremental=args.incremental)
 
 		if args.cm: 
 			print('!### Task: cm')
 			call = TASKS['cm']
-			call.main()
+			call.main(sweep=args.sweep, jobs=args.jobs[0], summary=args.summary, incremental=args.incremental, bbox=args.bbox, margin=args.margin[0])
 
 		if args.ge: 
 			print('!### Task: ge')
@@ -89,7 +89,7 @@ class Ring:
 		if args.si: 
 			print('!### Task: si')
 			call = TASKS['si']
-			call.main(times=args.times[0], cities=args.cities)
+			call.main(times=args.times[0], cities=args.cities, summary=args.summary, bbox=args.bbox, margin=args.margin[0], raster=args.raster, kde=args.kde[0], table=args.table, cache_size=args.cache[0], routing=args.routing[0], tolerance=args.tolerance[0])
 
 		if args.pl: 
 			print('!### Task: pl')
@@ -103,6 +103,18 @@ if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='CERVA')
 	parser.add_argument('--times', metavar='t', type=int, nargs=1, default=20, action='store', help='Quantity of times executed')
 	parser.add_argument('--cities', metavar='c', type=str, nargs='*', default=['austin'], action='store', help='Lower case city name')
+	parser.add_argument('--jobs', metavar='j', type=int, nargs=1, default=[1], action='store', help='Quantity of parallel processes')
+	parser.add_argument('--sweep', metavar='s', type=str, nargs='*', default=None, action='store', help='Clustering parameters as eps:min_samples, saved at mapped/sweep/')
+	parser.add_argument('--bbox', help='Save and fit only the incidents around the scenario box (the .net extent or the configured box), scored as the whole window. The cm task still clusters the whole city and evaluates the kernel of every window that reaches the box, so it is slower while each simulation fits less', action='store_true')
+	parser.add_argument('--margin', metavar='m', type=float, nargs=1, default=[0.05], action='store', help='Least degrees kept around the scenario box, kernels keep at least 4 bandwidths')
+	parser.add_argument('--kde', metavar='k', type=str, nargs=1, default=['gaussian'], choices=['gaussian', 'binned'], action='store', help='KDE backend, gaussian or binned (FFT)')
+	parser.add_argument('--raster', help='Score roads from precomputed memory-mapped risk rasters', action='store_true')
+	parser.add_argument('--cache', metavar='mb', type=float, nargs=1, default=[512], action='store', help='Memory budget of the fitted kernels of a simulation, in megabytes')
+	parser.add_argument('--table', help='Score roads from a per-edge, per-window table cached by net and mapped data', action='store_true')
+	parser.add_argument('--routing', metavar='r', type=str, nargs=1, default=['dijkstra'], choices=['dijkstra', 'cch'], action='store', help='Rerouting backend, dijkstra or cch (customizable contraction hierarchies)')
+	parser.add_argument('--tolerance', metavar='f', type=float, nargs=1, default=[0.0], action='store', help='Relative weight change a rerouting keeps its cached routes through, 0 drops them on every change')
+	parser.add_argument('--incremental', help='Clean and map only the new input files', action='store_true')
+	parser.add_argument('--summary', help='Map and score contexts by cluster summaries instead of points', action='store_true')
 	parser.add_argument('--cd', help='Clean data', action='store_true')
 	parser.add_argument('--cm', help='Context mapping', action='store_true')
 	parser.add_argument('--ge', help='Scenario generator', action='store_true')